@@ -0,0 +1,151 @@
+"""Intraprocedural alias analysis of Bril pointers
+
+Every pointer variable is mapped to the allocation sites it may point to,
+each with the range of offsets from the start of the allocation that it
+may have. A site is the index of an alloc in the function, or "*" for the
+pointers that come from outside of it (arguments, loads and call results).
+The analysis is flow-insensitive: the sites and the ranges are the union
+of those of all the definitions of a variable, and the ranges of the int
+variables used as offsets are computed the same way. Ranges that keep
+growing, like the one of a loop counter, are widened to infinity.
+"""
+
+from bytecode import is_pointer
+
+INF = float("inf")
+FULL = (-INF, INF)
+WIDEN = 3 # updates of a range before widening it
+
+
+def join(old, new, updates, key):
+    """Return the hull of two ranges, widened if the range of key keeps
+    changing
+    """
+    if old is None:
+        return new
+    lo, hi = min(old[0], new[0]), max(old[1], new[1])
+    if (lo, hi) != old:
+        updates[key] = updates.get(key, 0) + 1
+        if updates[key] > WIDEN:
+            lo = -INF if lo < old[0] else lo
+            hi = INF if hi > old[1] else hi
+    return (lo, hi)
+
+
+def int_ranges(func):
+    """Return the range of values of every int variable
+    """
+    ranges = {}
+    for arg in func.get("args", []):
+        if arg["type"] == "int":
+            ranges[arg["name"]] = FULL
+    updates = {}
+    changed = True
+    while changed:
+        changed = False
+        for instr in func["instrs"]:
+            if instr.get("type") != "int" or "dest" not in instr:
+                continue
+            op, args = instr["op"], instr.get("args", [])
+            if op == "const":
+                new = (instr["value"], instr["value"])
+            elif op in ["id", "add", "sub"]:
+                if any(arg not in ranges for arg in args):
+                    continue # not known yet
+                a = ranges[args[0]]
+                if op == "id":
+                    new = a
+                elif op == "add":
+                    b = ranges[args[1]]
+                    new = (a[0] + b[0], a[1] + b[1])
+                else:
+                    b = ranges[args[1]]
+                    new = (a[0] - b[1], a[1] - b[0])
+            else:
+                new = FULL
+            dest = instr["dest"]
+            old = ranges.get(dest)
+            ranges[dest] = join(old, new, updates, dest)
+            changed |= ranges[dest] != old
+    return ranges
+
+
+def points_to(func, ranges):
+    """Return the sites of every pointer variable with their offset ranges
+    """
+    points = {}
+    for arg in func.get("args", []):
+        if is_pointer(arg["type"]):
+            points[arg["name"]] = {"*": FULL}
+    updates = {}
+    changed = True
+    while changed:
+        changed = False
+        for i, instr in enumerate(func["instrs"]):
+            if not is_pointer(instr.get("type")) or "dest" not in instr:
+                continue
+            op, args = instr["op"], instr.get("args", [])
+            if op == "alloc":
+                new = {i: (0, 0)}
+            elif op == "id":
+                new = points.get(args[0], {})
+            elif op == "ptradd":
+                lo, hi = ranges.get(args[1], FULL)
+                new = {site: (r[0] + lo, r[1] + hi) for site, r in points.get(args[0], {}).items()}
+            else: # load, call
+                new = {"*": FULL}
+            dest = instr["dest"]
+            old = points.setdefault(dest, {})
+            for site, r in new.items():
+                joined = join(old.get(site), r, updates, (dest, site))
+                if old.get(site) != joined:
+                    old[site] = joined
+                    changed = True
+    return points
+
+
+def escaping_sites(func, points):
+    """Return the sites whose pointers leave the function or are stored,
+    so that pointers from outside may point to them
+    """
+    sites = set()
+    for instr in func["instrs"]:
+        args = instr.get("args", [])
+        if instr.get("op") in ["call", "ret"]:
+            escaped = args
+        elif instr.get("op") == "store":
+            escaped = args[1:]
+        else:
+            continue
+        for arg in escaped:
+            sites.update(points.get(arg, {}))
+    return sites
+
+
+class AliasAnalysis(object):
+
+    def __init__(self, func) -> None:
+        self.ranges = int_ranges(func)
+        self.points = points_to(func, self.ranges)
+        self.escaping = escaping_sites(func, self.points)
+
+    def sites(self, ptr):
+        return self.points.get(ptr) or {"*": FULL}
+
+    def may_alias(self, p, q):
+        """Return whether the pointers p and q may address the same cell
+        """
+        if p == q:
+            return True
+        a, b = self.sites(p), self.sites(q)
+        for site, (lo, hi) in a.items():
+            if site in b and site != "*" and lo <= b[site][1] and b[site][0] <= hi:
+                return True
+        return ("*" in a and any(site == "*" or site in self.escaping for site in b)) or \
+               ("*" in b and any(site in self.escaping for site in a))
+
+    def is_local(self, ptr):
+        """Return whether ptr only points to allocations that no other
+        function can reach
+        """
+        return all(site != "*" and site not in self.escaping for site in self.sites(ptr))
@@ -0,0 +1,308 @@
+"""Run one Bril program over many argument vectors at once.
+
+Every variable of main holds a NumPy array with one lane per argument
+vector, so arithmetic and comparisons are executed once for all the
+lanes. A divergent branch splits the active lanes with masks, and the two
+sides run one after the other until they reconverge at the immediate
+post-dominator of the branch. Lanes reaching an instruction that has no
+vector form (calls, memory, speculation) leave the batch and finish on
+the scalar interpreter from where they are. Integers are 64-bit, while
+the interpreter keeps unbounded Python integers, so the lanes whose int
+arithmetic wraps around leave the batch too, and a variable has a single
+type across the lanes.
+
+NumPy is only needed by this module, so bvm.py imports it on --batch.
+"""
+
+import io
+import numpy as np
+from bytecode import *
+from pyjit import find_leaders
+
+def int_divide(a, b):
+    """Bril's int division of the lanes, which truncates toward zero
+    """
+    q = np.floor_divide(a, b)
+    return q + ((q < 0) & (q * b != a))
+
+BINARY_UFUNCS = {
+    ADD: np.add, SUB: np.subtract, MUL: np.multiply, DIV: int_divide,
+    AND: np.bitwise_and, OR: np.bitwise_or,
+    LT: np.less, GT: np.greater, EQ: np.equal, NE: np.not_equal,
+    LE: np.less_equal, GE: np.greater_equal,
+    FADD: np.add, FSUB: np.subtract, FMUL: np.multiply, FDIV: np.true_divide,
+    FEQ: np.equal, FLT: np.less, FGT: np.greater, FLE: np.less_equal, FGE: np.greater_equal,
+}
+
+# booleans behave as integers in Python arithmetic, but not in NumPy
+ARITHMETIC_OPS = (ADD, SUB, MUL, DIV, NEG)
+
+INT64_MIN = np.iinfo(np.int64).min
+
+VECTOR_OPS = set(BINARY_UFUNCS) | {CONST, ID, NEG, NOT, JMP, BR, PRINT, NOP, RET, END}
+
+EXIT = -1 # virtual exit node, also used as "never reconverge"
+
+
+def post_dominators(func):
+    """Return the immediate post-dominator of every block of a function,
+    as a map from leader pc to leader pc (EXIT for the exit node)
+    """
+    leaders = find_leaders(func)
+    bounds = leaders + [len(func.instrs)]
+    succs = {}
+    for i, start in enumerate(leaders):
+        last = func.instrs[bounds[i + 1] - 1]
+        op = last[0]
+        if op == JMP:
+            succs[start] = [last[1]]
+        elif op == BR:
+            succs[start] = [last[2], last[3]]
+        elif op in (RET, END):
+            succs[start] = [EXIT]
+        elif op == GUARD:
+            succs[start] = [last[2], bounds[i + 1]]
+        else:
+            succs[start] = [bounds[i + 1]]
+    nodes = set(leaders) | {EXIT}
+    pdom = {block: set(nodes) for block in leaders}
+    pdom[EXIT] = {EXIT}
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(leaders):
+            new = set.intersection(*[pdom[succ] for succ in succs[block]]) | {block}
+            if new != pdom[block]:
+                pdom[block] = new
+                changed = True
+    ipdom = {}
+    for block in leaders:
+        strict = pdom[block] - {block}
+        for cand in strict:
+            if pdom[cand] == strict:
+                ipdom[block] = cand
+                break
+        else: # cannot reach the exit, e.g., an infinite loop
+            ipdom[block] = EXIT
+    return ipdom
+
+
+class BatchMachine(object):
+    """Execute main over a batch of argument vectors
+
+    vm_class: VirtualMachine of the lesson, used for the lanes that fall
+              back to scalar execution and for the report of every lane
+    funcs: functions already decoded from program (see brilc.py)
+    """
+
+    def __init__(self, program, vm_class, arg_lines, funcs=None) -> None:
+        self.program = program
+        self.vm_class = vm_class
+        self.vm = vm_class(program, funcs=funcs)
+        self.func = self.vm.funcs["main"]
+        self.size = len(arg_lines)
+        # the block containing each pc, and where its branch reconverges
+        leaders = find_leaders(self.func)
+        bounds = leaders + [len(self.func.instrs)]
+        self.block = [0] * len(self.func.instrs)
+        for i, start in enumerate(leaders):
+            for pc in range(start, bounds[i + 1]):
+                self.block[pc] = start
+        self.ipdom = post_dominators(self.func)
+        # registers, one array per slot
+        self.regs = [None] * len(self.func.slots)
+        for i, arg in enumerate(self.func.args):
+            if arg["type"] in ["int", "bool"]:
+                conv = int
+            elif arg["type"] == "float":
+                conv = float
+            else:
+                raise RuntimeError("Not supported types")
+            self.regs[i] = np.array([conv(line[i]) for line in arg_lines])
+        self.alive = np.ones(self.size, dtype=bool)
+        self.counts = np.zeros(self.size, dtype=np.int64)
+        self.outputs = [[] for _ in range(self.size)]
+        self.done = [False] * self.size # finished on the scalar interpreter
+
+    def eval(self):
+        """Run all the lanes and return the output of each of them
+        """
+        # entries of (pc, active lanes, pc where they stop)
+        stack = [(0, self.alive.copy(), EXIT)]
+        with np.errstate(all="ignore"): # inactive lanes compute garbage
+            while stack:
+                pc, mask, stop = stack.pop()
+                mask &= self.alive
+                if mask.any():
+                    self.run(pc, mask, stop, stack)
+        for lane in range(self.size):
+            if not self.done[lane]:
+                self.vm.instr_count = int(self.counts[lane])
+                self.report(lane, self.vm)
+        return ["".join(output) for output in self.outputs]
+
+    def run(self, pc, mask, stop, stack):
+        instrs = self.func.instrs
+        regs = self.regs
+        full = not (self.alive & ~mask).any()
+        while pc != stop:
+            instr = instrs[pc]
+            op = instr[0]
+            if op not in VECTOR_OPS:
+                self.fallback(mask, pc)
+                return
+            if op == END:
+                self.alive &= ~mask
+                return
+            self.counts += mask
+            if op in BINARY_UFUNCS:
+                a, b = regs[instr[2]], regs[instr[3]]
+                if op in (DIV, FDIV) and (mask & (b == 0)).any():
+                    # Python raises on these lanes
+                    self.fallback(mask & (b == 0), pc, counted=True)
+                    mask = mask & (b != 0)
+                    full = False
+                    if not mask.any():
+                        return
+                if op in ARITHMETIC_OPS:
+                    a, b = as_number(a), as_number(b)
+                try:
+                    value = BINARY_UFUNCS[op](a, b)
+                except TypeError:
+                    self.fallback(mask, pc, counted=True)
+                    return
+                if op in ARITHMETIC_OPS:
+                    wrapped = mask & overflow(op, a, b, value)
+                    if wrapped.any():
+                        self.fallback(wrapped, pc, counted=True)
+                        mask = mask & ~wrapped
+                        full = False
+                        if not mask.any():
+                            return
+                self.write(instr[1], value, mask, full)
+            elif op == CONST:
+                self.write(instr[1], np.full(self.size, instr[2]), mask, full)
+            elif op == ID:
+                self.write(instr[1], regs[instr[2]], mask, full)
+            elif op == NEG:
+                a = as_number(regs[instr[2]])
+                try:
+                    value = -a
+                except TypeError:
+                    self.fallback(mask, pc, counted=True)
+                    return
+                wrapped = mask & overflow(op, a, None, value)
+                if wrapped.any():
+                    self.fallback(wrapped, pc, counted=True)
+                    mask = mask & ~wrapped
+                    full = False
+                    if not mask.any():
+                        return
+                self.write(instr[1], value, mask, full)
+            elif op == NOT:
+                a = regs[instr[2]]
+                if a is None:
+                    self.fallback(mask, pc, counted=True)
+                    return
+                # logical, as ~ would flip every bit of the lanes as integers
+                self.write(instr[1], np.logical_not(a), mask, full)
+            elif op == PRINT:
+                reg = regs[instr[1]]
+                lanes = np.flatnonzero(mask)
+                values = [None] * len(lanes) if reg is None else reg[mask].tolist()
+                for lane, value in zip(lanes, values):
+                    self.outputs[lane].append("{}\n".format(value))
+            elif op == JMP:
+                pc = instr[1]
+                continue
+            elif op == BR:
+                cond = regs[instr[1]].astype(bool)
+                taken = mask & cond
+                not_taken = mask & ~cond
+                if not not_taken.any():
+                    pc = instr[2]
+                elif not taken.any():
+                    pc = instr[3]
+                else:
+                    join = self.ipdom[self.block[pc]]
+                    if join != stop:
+                        stack.append((join, mask, stop))
+                    # lanes jumping right to the join point just wait there
+                    if instr[3] != join:
+                        stack.append((instr[3], not_taken, join))
+                    if instr[2] != join:
+                        stack.append((instr[2], taken, join))
+                    return
+                continue
+            elif op == RET:
+                self.alive &= ~mask
+                return
+            pc += 1
+
+    def write(self, dest, value, mask, full):
+        old = self.regs[dest]
+        if full or old is None:
+            self.regs[dest] = value
+        else:
+            self.regs[dest] = np.where(mask, value, old)
+
+    def fallback(self, mask, pc, counted=False):
+        """Finish the given lanes on the scalar interpreter, starting at pc
+        """
+        if counted:
+            self.counts -= mask
+        for lane in np.flatnonzero(mask):
+            buf = io.StringIO()
+            vm = self.vm_class(self.program, funcs=self.vm.funcs, out=buf)
+            vm.instr_count = int(self.counts[lane])
+            frame = Frame(self.func, [])
+            frame.data = [None if reg is None else reg[lane].item() for reg in self.regs]
+            frame.pc = pc
+            try:
+                vm.eval_frame(frame)
+                vm.report()
+            except Exception as err:
+                # only this lane fails, as it would when run on its own
+                buf.write("{}: {}\n".format(type(err).__name__, err))
+            self.outputs[lane].append(buf.getvalue())
+            self.done[lane] = True
+        self.alive &= ~mask
+
+    def report(self, lane, vm):
+        vm.out = io.StringIO()
+        vm.report()
+        self.outputs[lane].append(vm.out.getvalue())
+
+
+def as_number(value):
+    if value is not None and value.dtype == bool:
+        return value.astype(np.int64)
+    return value
+
+
+def overflow(op, a, b, value):
+    """Return the lanes where the value of the int operation op on a and b
+    wrapped around 64 bits, i.e., differs from the one of the interpreter
+    """
+    if value.dtype != np.int64:
+        return np.zeros(value.shape, dtype=bool)
+    if op == ADD: # the sign of the sum differs from the ones of both terms
+        return ((a ^ value) & (b ^ value)) < 0
+    if op == SUB:
+        return ((a ^ b) & (a ^ value)) < 0
+    if op == MUL: # a wrapped product divided by b is not a
+        nonzero = b != 0
+        return (nonzero & (value // np.where(nonzero, b, 1) != a)) | ((a == INT64_MIN) & (b == -1))
+    if op == DIV:
+        return (a == INT64_MIN) & (b == -1)
+    return a == INT64_MIN # NEG
+
+
+def run_batch(program, vm_class, filename, funcs=None):
+    """Run program once per line of arguments in filename and print the
+    output of every run in order
+    """
+    with open(filename, "r") as infile:
+        arg_lines = [line.split() for line in infile if line.strip()]
+    for output in BatchMachine(program, vm_class, arg_lines, funcs).eval():
+        print(output, end="")
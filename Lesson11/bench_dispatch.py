@@ -0,0 +1,109 @@
+"""Micro-benchmark of the per-opcode dispatch cost of the BVM interpreter
+
+    python3 bench_dispatch.py [path/to/bvm.py ...]
+
+Every opcode is timed in a loop whose body holds many copies of it, and the
+cost of the empty loop is subtracted. Passing several versions of bvm.py
+(e.g., ../Lesson12/bvm.py, or a checkout of an older commit) compares them
+side by side.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import subprocess
+
+ITERS = 4000
+REPEAT = 50
+
+def const(dest, value):
+    return {"op": "const", "dest": dest, "type": "int", "value": value}
+
+def binary(op):
+    return lambda i: [{"op": op, "dest": "t", "type": "int", "args": ["x", "y"]}]
+
+BODIES = {
+    "const": lambda i: [const("t", 1)],
+    "id": lambda i: [{"op": "id", "dest": "t", "type": "int", "args": ["x"]}],
+    "add": binary("add"),
+    "sub": binary("sub"),
+    "mul": binary("mul"),
+    "div": binary("div"),
+    "and": binary("and"),
+    "or": binary("or"),
+    "lt": binary("lt"),
+    "eq": binary("eq"),
+    "ge": binary("ge"),
+    "not": lambda i: [{"op": "not", "dest": "t", "type": "bool", "args": ["c"]}],
+    "jmp": lambda i: [{"op": "jmp", "labels": ["l{}".format(i)]}, {"label": "l{}".format(i)}],
+    "br": lambda i: [{"op": "br", "args": ["c"], "labels": ["l{}".format(i), "l{}".format(i)]}, {"label": "l{}".format(i)}],
+    "ptradd": lambda i: [{"op": "ptradd", "dest": "q", "type": {"ptr": "int"}, "args": ["p", "zero"]}],
+    "load": lambda i: [{"op": "load", "dest": "t", "type": "int", "args": ["p"]}],
+    "store": lambda i: [{"op": "store", "args": ["p", "x"]}],
+    "call+ret": lambda i: [{"op": "call", "funcs": ["f"]}],
+    "print": lambda i: [{"op": "print", "args": ["x"]}],
+    "nop": lambda i: [{"op": "nop"}],
+}
+
+def make_program(body):
+    instrs = [const("zero", 0), const("one", 1), const("x", 7), const("y", 3),
+              const("n", ITERS), const("i", 0),
+              {"op": "lt", "dest": "c", "type": "bool", "args": ["zero", "one"]},
+              {"op": "alloc", "dest": "p", "type": {"ptr": "int"}, "args": ["one"]},
+              {"label": "loop"},
+              {"op": "lt", "dest": "cond", "type": "bool", "args": ["i", "n"]},
+              {"op": "br", "args": ["cond"], "labels": ["body", "done"]},
+              {"label": "body"}]
+    for i in range(REPEAT):
+        instrs += body(i)
+    instrs += [{"op": "add", "dest": "i", "type": "int", "args": ["i", "one"]},
+               {"op": "jmp", "labels": ["loop"]},
+               {"label": "done"},
+               {"op": "free", "args": ["p"]}]
+    return {"functions": [{"name": "main", "instrs": instrs},
+                          {"name": "f", "instrs": [{"op": "ret"}]}]}
+
+def run_once(bvm, program):
+    vm = bvm.VirtualMachine(program)
+    start = time.perf_counter()
+    vm.eval_frame(bvm.Frame(vm.funcs["main"], []))
+    return time.perf_counter() - start
+
+def measure(path):
+    """Return the cost in ns of each opcode for the given bvm.py
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    bvm = importlib.import_module(os.path.splitext(os.path.basename(path))[0])
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    empty = min(run_once(bvm, make_program(lambda i: [])) for _ in range(5))
+    res = {}
+    for name, body in BODIES.items():
+        try:
+            best = min(run_once(bvm, make_program(body)) for _ in range(5))
+            res[name] = (best - empty) / (ITERS * REPEAT) * 1e9
+        except Exception:
+            res[name] = None # not supported by this version
+    sys.stdout = stdout
+    return res
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-opcode cost of the interpreter')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('vms', nargs='*', default=[os.path.join(os.path.dirname(os.path.abspath(__file__)), "bvm.py")])
+    args = parser.parse_args()
+    if args.worker:
+        print(json.dumps(measure(args.vms[0])))
+        sys.exit(0)
+    # every version runs in its own process so that their modules do not clash
+    results = []
+    for path in args.vms:
+        out = subprocess.check_output([sys.executable, __file__, "--worker", path])
+        results.append(json.loads(out))
+    print("{:<10}".format("op") + "".join("{:>14}".format("vm{} (ns)".format(i)) for i in range(len(results))))
+    for name in BODIES:
+        cols = ["{:>14}".format("-" if res[name] is None else "{:.1f}".format(res[name])) for res in results]
+        print("{:<10}".format(name) + "".join(cols))
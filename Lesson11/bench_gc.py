@@ -0,0 +1,111 @@
+"""Benchmark of the garbage collectors of the BVM
+
+    python3 bench_gc.py [--engine pyjit] [--heap 4096]
+
+Runs the memory tests and generated pointer-heavy programs with reference
+counting and with the tracing collectors of collector.py, and reports the
+time of every run, next to the number of collections and the most cells
+in use at once over all the heaps. The generated programs are
+
+    garbage: allocates a block per iteration and drops the previous one
+    table:   replaces the blocks referenced by a table of pointers
+    scan:    walks a live array with ptradd and load, without allocating
+"""
+
+import os
+import json
+import time
+import argparse
+import bvm
+
+ROUNDS = 200
+SLOTS = 32 # size of the table and of the scanned array
+
+TESTS = {
+    "test/bubblesort.json": [5, 10, 7, 5, 1, 3],
+    "test/eight-queens.json": [6],
+    "test/double-alloc.json": [],
+    "test/fib.json": [],
+    "test/func-call.json": [],
+    "test/mem.json": [],
+    "test/ret-alloc.json": [],
+}
+
+INT_PTR = {"ptr": "int"}
+
+def const(dest, value):
+    return {"op": "const", "dest": dest, "type": "int", "value": value}
+
+def op(name, dest, typ, *args):
+    return {"op": name, "dest": dest, "type": typ, "args": list(args)}
+
+def loop(var, bound, body):
+    """Return the instructions of `for var in range(bound): body`
+    """
+    return [const(var, 0),
+            {"label": var + "_loop"},
+            op("lt", var + "_cond", "bool", var, bound),
+            {"op": "br", "args": [var + "_cond"], "labels": [var + "_body", var + "_done"]},
+            {"label": var + "_body"}] + body + \
+           [op("add", var, "int", var, "one"),
+            {"op": "jmp", "labels": [var + "_loop"]},
+            {"label": var + "_done"}]
+
+def garbage():
+    body = [op("alloc", "p", INT_PTR, "size"),
+            {"op": "store", "args": ["p", "i"]},
+            op("load", "x", "int", "p"),
+            op("add", "sum", "int", "sum", "x")]
+    return [const("size", 4)] + loop("i", "n", body)
+
+def table():
+    fill = [op("alloc", "e", INT_PTR, "size"),
+            {"op": "store", "args": ["e", "i"]},
+            op("ptradd", "q", {"ptr": INT_PTR}, "t", "j"),
+            {"op": "store", "args": ["q", "e"]}]
+    read = [op("ptradd", "q", {"ptr": INT_PTR}, "t", "k"),
+            op("load", "e", INT_PTR, "q"),
+            op("load", "x", "int", "e"),
+            op("add", "sum", "int", "sum", "x")]
+    return [const("size", 4), op("alloc", "t", {"ptr": INT_PTR}, "slots")] + \
+           loop("i", "n", loop("j", "slots", fill)) + loop("k", "slots", read)
+
+def scan():
+    read = [op("ptradd", "q", INT_PTR, "a", "j"),
+            op("load", "x", "int", "q"),
+            op("add", "sum", "int", "sum", "x")]
+    return [op("alloc", "a", INT_PTR, "slots")] + loop("i", "n", loop("j", "slots", read))
+
+PROGRAMS = {"garbage": garbage, "table": table, "scan": scan}
+
+def make_program(body):
+    instrs = [const("one", 1), const("n", ROUNDS), const("slots", SLOTS), const("sum", 0)] + body() + \
+             [{"op": "print", "args": ["sum"]}]
+    return {"functions": [{"name": "main", "instrs": instrs}]}
+
+def run_once(program, args, engine, gc):
+    vm = bvm.VirtualMachine(program, engine, gc=gc)
+    start = time.perf_counter()
+    vm.run(args)
+    elapsed = time.perf_counter() - start
+    collections = vm.collector.num_collections if vm.collector is not None else 0
+    return elapsed, collections, sum(heap.peak for heap in vm.heaps)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time of the garbage collectors')
+    parser.add_argument('--engine', default="interp", choices=["interp", "pyjit"], help='execution engine')
+    parser.add_argument('--heap', type=int, default=bvm.MEMORY_SIZE, help='initial cells of every heap')
+    args = parser.parse_args()
+    bvm.MEMORY_SIZE = args.heap
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    programs = [(name, json.load(open(name)), test_args) for name, test_args in TESTS.items()]
+    programs += [(name, make_program(body), []) for name, body in PROGRAMS.items()]
+    gcs = ["refcount", "marksweep", "copying"]
+    print("{:<24}".format("program") + "".join("{:>22}".format(gc) for gc in gcs))
+    for name, program, test_args in programs:
+        line = "{:<24}".format(name)
+        for gc in gcs:
+            runs = [run_once(program, test_args, args.engine, gc) for _ in range(3)]
+            elapsed = min(run[0] for run in runs)
+            line += "{:>10.2f}ms{:>4}gc{:>6}".format(1000 * elapsed, runs[0][1], runs[0][2])
+        print(line)
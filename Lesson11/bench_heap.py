@@ -0,0 +1,117 @@
+"""Benchmark of the heap allocator of the BVM on alloc/free-heavy programs
+
+    python3 bench_heap.py [path/to/bvm.py ...]
+
+Every program keeps a number of live arrays, and replaces them in a loop
+by freeing each one and allocating it again with a new size, drawn at
+random for every alloc instruction. The throughput is the number of allocs
+and frees per second of the whole run, and the peak is the most cells in
+use at once, next to the highest address ever allocated, which also counts
+the holes left by fragmentation. Passing several versions of bvm.py (e.g., a
+checkout of an older commit) compares them side by side.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+
+ITERS = 200
+ROUNDS = 8 # replacements of every array per iteration
+
+# name->(number of live arrays, sizes to draw from)
+PROGRAMS = {
+    "churn": (1, list(range(1, 33))),
+    "window": (16, list(range(1, 65))),
+    "mixed": (64, list(range(1, 9)) * 20 + [200]),
+}
+
+def const(dest, value):
+    return {"op": "const", "dest": dest, "type": "int", "value": value}
+
+def alloc(dest, size_var):
+    return {"op": "alloc", "dest": dest, "type": {"ptr": "int"}, "args": [size_var]}
+
+def make_program(slots, sizes):
+    """Return the program and its number of allocs and frees
+    """
+    rand = random.Random(42)
+    used = sorted(set(sizes))
+    instrs = [const("s{}".format(size), size) for size in used]
+    instrs += [const("one", 1), const("n", ITERS), const("i", 0)]
+    for j in range(slots):
+        instrs.append(alloc("p{}".format(j), "s{}".format(rand.choice(sizes))))
+    instrs += [{"label": "loop"},
+               {"op": "lt", "dest": "cond", "type": "bool", "args": ["i", "n"]},
+               {"op": "br", "args": ["cond"], "labels": ["body", "done"]},
+               {"label": "body"}]
+    for _ in range(ROUNDS):
+        for j in range(slots):
+            instrs.append({"op": "free", "args": ["p{}".format(j)]})
+            instrs.append(alloc("p{}".format(j), "s{}".format(rand.choice(sizes))))
+    instrs += [{"op": "add", "dest": "i", "type": "int", "args": ["i", "one"]},
+               {"op": "jmp", "labels": ["loop"]},
+               {"label": "done"}]
+    for j in range(slots):
+        instrs.append({"op": "free", "args": ["p{}".format(j)]})
+    ops = 2 * slots * (ROUNDS * ITERS + 1)
+    return {"functions": [{"name": "main", "instrs": instrs}]}, ops
+
+def run_once(bvm, program, policy):
+    if policy is None:
+        vm = bvm.VirtualMachine(program)
+    else:
+        vm = bvm.VirtualMachine(program, alloc_policy=policy)
+    start = time.perf_counter()
+    vm.eval_frame(bvm.Frame(vm.funcs["main"], []))
+    elapsed = time.perf_counter() - start
+    if not hasattr(vm, "heaps"): # bump allocator
+        return elapsed, None, None
+    heap = vm.heaps[bvm.INT_HEAP]
+    return elapsed, heap.peak, heap.top
+
+def measure(path, policies):
+    """Return the throughput, peak and top of each program and policy for
+    the given bvm.py, or None where the run fails
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    bvm = __import__(os.path.splitext(os.path.basename(path))[0])
+    if not hasattr(bvm, "Heap"):
+        policies = [None] # bump allocator
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    res = {}
+    for name, (slots, sizes) in PROGRAMS.items():
+        program, ops = make_program(slots, sizes)
+        for policy in policies:
+            key = "{} ({})".format(name, policy or "bump")
+            try:
+                runs = [run_once(bvm, program, policy) for _ in range(3)]
+                res[key] = (ops / min(run[0] for run in runs), runs[0][1], runs[0][2])
+            except Exception:
+                res[key] = None # e.g., out of memory
+    sys.stdout = stdout
+    return res
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Throughput and peak use of the heap allocator')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--alloc', nargs='+', default=["first", "best"], help='fit policies to compare')
+    parser.add_argument('vms', nargs='*', default=[os.path.join(os.path.dirname(os.path.abspath(__file__)), "bvm.py")])
+    args = parser.parse_args()
+    if args.worker:
+        print(json.dumps(measure(args.vms[0], args.alloc)))
+        sys.exit(0)
+    # every version runs in its own process so that their modules do not clash
+    for i, path in enumerate(args.vms):
+        out = subprocess.check_output([sys.executable, __file__, "--worker", path, "--alloc"] + args.alloc)
+        print("vm{}: {}".format(i, path))
+        print("{:<18}{:>14}{:>8}{:>8}".format("program", "ops/s", "peak", "top"))
+        for key, res in json.loads(out).items():
+            if res is None:
+                print("{:<18}{:>14}".format(key, "failed"))
+            else:
+                print("{:<18}{:>14.0f}{:>8}{:>8}".format(key, *res))
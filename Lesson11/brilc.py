@@ -0,0 +1,134 @@
+"""On-disk cache of decoded programs
+
+bvm.py saves the decoded form of test/foo.json into test/foo.brilc. The
+cache starts with a header holding MAGIC, the FORMAT of the file, the
+SHA-256 hash of BVM_VERSION and of the bytes of the JSON file, and the
+size of the index. The index holds the program without the instructions
+of its functions, and where each function is stored in the rest of the
+file, as its own marshaled decoded form with its CRC-32. A later run only
+hashes the JSON file to check the cache, maps the cache into memory and
+reads the index; a function is only read, and its CRC checked, the first
+time it is called. A stale or corrupted cache is rebuilt, even when the
+corrupted function is only found in the middle of a run, which then goes
+on with the function decoded from the JSON file.
+"""
+
+import gc
+import os
+import json
+import mmap
+import zlib
+import struct
+import marshal
+import hashlib
+from bytecode import *
+
+MAGIC = b"BRILC"
+FORMAT = 3
+HEADER = struct.Struct("<5sH32sI") # magic, format, hash, index size
+
+
+def cache_path(filename):
+    return os.path.splitext(filename)[0] + ".brilc"
+
+
+def program_hash(data):
+    return hashlib.sha256(str(BVM_VERSION).encode() + b"\0" + data).digest()
+
+
+def load_cache(path, digest, rebuild):
+    """Return (program, functions) from the cache at path, or None if it
+    is missing, stale or corrupted
+
+    The program lacks the instructions of its functions, which are only
+    read from the cache when they are decoded. A function whose decoded
+    form turns out to be corrupted is decoded by rebuild(name) instead.
+    """
+    try:
+        with open(path, "rb") as infile:
+            mm = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, fmt, key, size = HEADER.unpack_from(mm)
+        if magic != MAGIC or fmt != FORMAT or key != digest:
+            mm.close()
+            return None
+        # the loaded objects hold no cycles for the collector to find
+        gc.disable()
+        try:
+            program, index = marshal.loads(mm[HEADER.size:HEADER.size + size])
+        finally:
+            gc.enable()
+        start = HEADER.size + size
+        if any(start + offset + length > len(mm) for offset, length, _ in index.values()):
+            mm.close()
+            return None
+    except (OSError, ValueError, EOFError, TypeError, struct.error):
+        return None
+
+    def decode(name):
+        # the map stays open as long as the functions may be decoded
+        offset, length, crc = index[name]
+        blob = mm[start + offset:start + offset + length]
+        if zlib.crc32(blob) == crc:
+            try:
+                return Function.load(marshal.loads(blob))
+            except (ValueError, EOFError, TypeError, IndexError):
+                pass
+        return rebuild(name)
+
+    return program, FunctionTable(index, decode)
+
+
+def save_cache(path, digest, program, funcs):
+    blobs = []
+    index = {} # name->(offset, size, CRC-32) of its decoded form
+    offset = 0
+    for func in funcs.decode_all():
+        blobs.append(marshal.dumps(func.save()))
+        index[func.name] = (offset, len(blobs[-1]), zlib.crc32(blobs[-1]))
+        offset += len(blobs[-1])
+    headers = [{key: value for key, value in func.items() if key != "instrs"}
+               for func in program["functions"]]
+    data = marshal.dumps((dict(program, functions=headers), index))
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp, "wb") as outfile:
+            outfile.write(HEADER.pack(MAGIC, FORMAT, digest, len(data)))
+            outfile.write(data)
+            for blob in blobs:
+                outfile.write(blob)
+        os.replace(tmp, path) # readers never see a partial cache
+    except OSError: # e.g., a read-only directory, run without the cache
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_program(filename, cache=True):
+    """Return the program in filename and its functions, decoded on
+    demand, from the cache when it is up to date
+
+    The functions of a program read from the cache have no instructions,
+    which are only found in their decoded form.
+    """
+    with open(filename, "rb") as infile:
+        data = infile.read()
+    if cache:
+        digest = program_hash(data)
+        path = cache_path(filename)
+        rebuilt = []
+
+        def rebuild(name):
+            # a corrupted function of the cache: decode the JSON file again
+            if not rebuilt:
+                program = json.loads(data)
+                rebuilt.append(decode_program(program))
+                save_cache(path, digest, program, rebuilt[0])
+            return rebuilt[0][name]
+
+        res = load_cache(path, digest, rebuild)
+        if res is not None:
+            return res
+    program = json.loads(data)
+    funcs = decode_program(program)
+    if cache:
+        save_cache(path, digest, program, funcs)
+    return program, funcs
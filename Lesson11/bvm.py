@@ -1,75 +1,110 @@
+import io
 import sys
 import json
 import argparse
+from bytecode import *
+from pyjit import Compiler
+from profiler import Profiler
+from memo import Memoizer
+from heap import Heap, Allocation, Pointer, POLICIES, HEAP_NAMES
+from collector import COLLECTORS, store_pointer, ignore
+from census import Census
+from brilc import load_program
+from ops import HANDLERS
 
-MEMORY_SIZE = 4096
-
-class Frame(object):
-
-    def __init__(self, name, instrs, initial_data = {}) -> None:
-        """
-        initial_data: maps from variable name to value
-        """
-        self.name = name
-        self.instrs = instrs
-        self.data = initial_data
-        self.blocks = {}
-        for idx, instr in enumerate(self.instrs):
-            if "label" in instr:
-                self.blocks[instr["label"]] = idx
-
-    def eval_const(self, instr) -> None:
-        self.data[instr["dest"]] = instr["value"]
-
-    def eval_binary_op(self, instr) -> None:
-        if instr["op"] == "add":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] + self.data[instr["args"][1]]
-        elif instr["op"] == "sub":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] - self.data[instr["args"][1]]
-        elif instr["op"] == "mul":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] * self.data[instr["args"][1]]
-        elif instr["op"] == "div":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] / self.data[instr["args"][1]]
-        elif instr["op"] == "or":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] | self.data[instr["args"][1]]
-        elif instr["op"] == "and":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] & self.data[instr["args"][1]]
-
-    def eval_compare_op(self, instr) -> None:
-        if instr["op"] == "lt":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] < self.data[instr["args"][1]]
-        elif instr["op"] == "gt":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] > self.data[instr["args"][1]]
-        elif instr["op"] == "eq":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] == self.data[instr["args"][1]]
-        elif instr["op"] == "ne":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] != self.data[instr["args"][1]]
-        elif instr["op"] == "le":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] <= self.data[instr["args"][1]]
-        elif instr["op"] == "ge":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] >= self.data[instr["args"][1]]
+MEMORY_SIZE = 4096 # initial cells of every heap, which grow on demand
+MAX_STACK_DEPTH = 100000
 
 
 class VirtualMachine(object):
 
-    def __init__(self, program) -> None:
-        self.funcs = program["functions"]
-        funcs_map = {}
-        for func in self.funcs:
-            funcs_map[func["name"]] = func
+    def __init__(self, program, engine="interp", max_depth=MAX_STACK_DEPTH, funcs=None, out=None, memo_size=0,
+                 alloc_policy="best", gc="refcount") -> None:
+        """
+        funcs: functions already decoded from program, e.g., by a previous VM
+        out: file receiving the output of the program (default: stdout)
+        memo_size: number of results of pure functions to cache (0: none)
+        alloc_policy: "first" or "best" fit of the heap allocator
+        gc: "refcount", or a tracing collector of collector.py
+        """
+        self.main = None
+        for func in program["functions"]:
             if func["name"] == "main":
                 self.main = func
-        self.funcs = funcs_map
+        # functions are decoded on their first call
+        self.funcs = funcs if funcs is not None else decode_program(program)
+        self.stdout = out if out is not None else sys.stdout
+        # execution engine: "interp" or "pyjit"
+        self.engine = engine
+        self.max_depth = max_depth
+        self.alloc_policy = alloc_policy
+        self.collector = None
+        if gc != "refcount":
+            self.collector = COLLECTORS[gc](self)
+            # pointers are plain values, found from the roots by the collector
+            self.set_pointer = store_pointer
+            self.retain_slots = self.release_slots = ignore
+            self.release_frame = self.release = ignore
+        # memoization of the pure functions, in the interpreter only
+        self.memo = None
+        self.census = None # sampled after every allocation when set
+        self.handlers = HANDLERS
+        if memo_size > 0:
+            if engine != "interp":
+                raise RuntimeError("Memoization needs the interp engine")
+            self.memo = Memoizer(program, self.funcs, memo_size)
+            self.handlers = self.memo.handlers
+        self.reset()
+
+    def reset(self):
+        """Start a new run on fresh state
+        """
+        self.out = self.stdout
+        # call stack
+        self.frame = None # running frame
+        self.stack = [] # suspended callers
+        self.retval = None
+        if self.memo is not None:
+            self.memo.keys = [] # the cached results are kept
         # memory facility
-        self.memory = [0] * MEMORY_SIZE
-        self.memory_usage = [False] * MEMORY_SIZE
-        self.memory_ptr = 0
-        self.allocated = {} # var->memory_size
-        # garbage collection
-        self.reference_count = {} # var->ref_count
-
-    def eval(self):
-        args = {}
+        if self.collector is not None:
+            self.heaps = self.collector.new_heaps(MEMORY_SIZE, self.alloc_policy)
+        else:
+            self.heaps = [Heap(MEMORY_SIZE, self.alloc_policy, kind) for kind in range(NUM_HEAPS)]
+        self.cells = [heap.cells for heap in self.heaps] # grown in place, or flipped by a copying collection
+        # garbage collection, by reference counting of the allocations
+        # unless a tracing collector is used
+        self.allocations = set() # live allocations
+        self.instr_count = 0
+
+    def eval(self, input_args):
+        """Run main with the given command-line arguments
+        """
+        self.run(input_args, self.stdout)
+
+    def run(self, input_args, stdout=None):
+        """Run main on fresh state, so that a loaded program can be run
+        many times, and return the result of the run as a dict
+
+        input_args: arguments of main, as strings or numbers
+        stdout: file receiving the output (default: kept in the result)
+        """
+        self.reset()
+        self.out = stdout if stdout is not None else io.StringIO()
+        frame = self.main_frame(input_args)
+        if self.engine == "pyjit":
+            retval = self.eval_compiled(frame)
+        else:
+            retval = self.eval_frame(frame)
+        self.report()
+        return {"output": self.out.getvalue() if stdout is None else None,
+                "retval": retval,
+                "instr_count": self.instr_count}
+
+    def main_frame(self, input_args):
+        """Return the frame of main with the command-line arguments
+        """
+        args = []
         if "args" in self.main:
             for i, arg in enumerate(self.main["args"]):
                 if arg["type"] in ["int", "bool"]:
@@ -78,117 +113,180 @@ class VirtualMachine(object):
                     val = float(input_args[i])
                 else:
                     raise RuntimeError("Not supported types")
-                args[arg["name"]] = val
-        self.eval_frame(Frame("main", self.funcs["main"]["instrs"], args))
+                args.append(val)
+        return Frame(self.funcs["main"], args)
+
+    def report(self):
+        """Check the memory after a finished run
+        """
+        if self.collector is not None: # nothing is reachable anymore
+            self.collector.collect()
         self.detect_memory_leak()
 
-    def eval_frame(self, frame) -> None:
-        pc = 0
-        while pc < len(frame.instrs):
-            instr = frame.instrs[pc]
-            # print(frame.data)
-            # print(instr)
-            pc += 1
-            if "label" in instr:
-                continue
-            elif "op" in instr:
-                if instr["op"] == "const":
-                    frame.eval_const(instr)
-                elif instr["op"] == "id":
-                    frame.data[instr["dest"]] = frame.data[instr["args"][0]]
-                    if instr["args"][0] in self.allocated:
-                        self.reference_count[instr["args"][0]] += 1
-                elif instr["op"] in ["add", "sub", "mul", "div", "or", "and"]:
-                    frame.eval_binary_op(instr)
-                elif instr["op"] in ["lt", "gt", "eq", "ne", "le", "ge"]:
-                    frame.eval_compare_op(instr)
-                elif instr["op"] == "jmp":
-                    pc = frame.blocks[instr["labels"][0]]
-                elif instr["op"] == "br":
-                    if frame.data[instr["args"][0]]: # true
-                        pc = frame.blocks[instr["labels"][0]]
-                    else: # false
-                        pc = frame.blocks[instr["labels"][1]]
-                elif instr["op"] == "alloc": # return the address
-                    # test if overwriting the original memory
-                    if instr["dest"] in self.allocated:
-                        self.decrease_reference_count(frame.data[instr["dest"]], instr["dest"])
-                    frame.data[instr["dest"]] = self.memory_ptr
-                    self.memory_ptr += frame.data[instr["args"][0]]
-                    self.allocated[instr["dest"]] = frame.data[instr["args"][0]]
-                    if self.memory_ptr > MEMORY_SIZE:
-                        raise RuntimeError("Out of memory")
-                    for loc in range(frame.data[instr["dest"]], self.memory_ptr):
-                        self.memory_usage[loc] = True
-                    self.reference_count[instr["dest"]] = 1
-                elif instr["op"] == "free":
-                    ptr = frame.data[instr["args"][0]]
-                    size = self.allocated[instr["args"][0]]
-                    self.free_memory(ptr, size)
-                    self.reference_count[instr["args"][0]] = 0
-                elif instr["op"] == "ptradd":
-                    frame.data[instr["dest"]] = frame.data[instr["args"][0]] + frame.data[instr["args"][1]]
-                elif instr["op"] == "load":
-                    frame.data[instr["dest"]] = self.memory[frame.data[instr["args"][0]]]
-                elif instr["op"] == "store":
-                    self.memory[frame.data[instr["args"][0]]] = frame.data[instr["args"][1]]
-                elif instr["op"] == "call":
-                    args = {}
-                    if "args" in instr:
-                        for outer_arg, func_arg in zip(instr["args"], self.funcs[instr["funcs"][0]]["args"]):
-                            args[func_arg["name"]] = frame.data[outer_arg]
-                    res = self.eval_frame(Frame(instr["funcs"][0], self.funcs[instr["funcs"][0]]["instrs"], args))
-                    if "dest" in instr:
-                        frame.data[instr["dest"]] = res
-                elif instr["op"] == "ret":
-                    if "args" in instr:
-                        for var in frame.data:
-                            if var in self.allocated and var != instr["args"][0]:
-                                self.decrease_reference_count(frame.data[var], var)
-                        return frame.data[instr["args"][0]]
-                    else:
-                        for var in frame.data:
-                            if var in self.allocated:
-                                self.decrease_reference_count(frame.data[var], var)
-                        return
-                elif instr["op"] == "print":
-                    print(frame.data[instr["args"][0]])
-                else:
-                    raise RuntimeError("Unknown instruction: {}".format(instr["op"]))
-        # implicit return
-        for var in frame.data:
-            if var in self.allocated:
-                self.decrease_reference_count(frame.data[var], var)
-
-    def decrease_reference_count(self, ptr, var):
-        self.reference_count[var] -= 1
-        if self.reference_count[var] == 0:
-            self.free_memory(ptr, self.allocated[var])
-            print("Free memory:", var)
-
-    def free_memory(self, ptr, size):
-        for loc in range(ptr, ptr+size):
-            if not self.memory_usage[loc]:
-                raise RuntimeError("Double free")
-            self.memory_usage[loc] = False
+    def eval_frame(self, frame):
+        """Run frame until the call stack is empty. Calls and returns do not
+        recurse in Python, they switch the running frame and its pc
+        """
+        self.frame = frame
+        handlers = self.handlers
+        count = 0
+        while frame is not None:
+            instrs = frame.instrs
+            pc = frame.pc
+            while pc >= 0:
+                instr = instrs[pc]
+                count += 1
+                pc = handlers[instr[0]](self, frame, instr, pc + 1)
+            frame = self.frame
+        self.instr_count += count
+        return self.retval
+
+    def eval_compiled(self, frame):
+        """Run frame with the pyjit engine, which jumps between the compiled
+        basic blocks instead of interpreting each instruction
+        """
+        self.frame = frame
+        while frame is not None:
+            blocks = frame.func.blocks
+            if blocks is None:
+                blocks = frame.func.blocks = Compiler(frame.func, HANDLERS).compile()
+            data = frame.data
+            pc = frame.pc
+            while pc >= 0:
+                pc = blocks[pc](self, frame, data)
+            frame = self.frame
+        return self.retval
+
+    def alloc(self, site, size, heap):
+        """Return a pointer to a new block, which nothing references yet
+
+        site: (function, variable, pc) of the alloc instruction
+        """
+        if self.collector is not None and self.heaps[heap].used + size > self.collector.thresholds[heap]:
+            self.collector.collect(heap, size)
+        start = self.heaps[heap].alloc(size)
+        alloc = Allocation(heap, start, size, site)
+        self.allocations.add(alloc)
+        if self.census is not None:
+            self.census.count(self)
+        return Pointer(alloc, start)
+
+    def free(self, ptr):
+        alloc = ptr.alloc
+        if not alloc.live:
+            raise RuntimeError("Double free of {}".format(alloc))
+        if ptr.addr != alloc.start:
+            raise RuntimeError("Free of a pointer inside {}".format(alloc))
+        self.reclaim(alloc)
+
+    def set_pointer(self, data, index, ptr):
+        """Write ptr into a register or a pointer cell, which then references
+        its allocation instead of the one of the old pointer
+        """
+        old = data[index]
+        data[index] = ptr
+        if old is not None and ptr is not None and old.alloc is ptr.alloc:
+            return # e.g., a loop moving a pointer in an array
+        if ptr is not None:
+            ptr.alloc.refs += 1
+        if old is not None:
+            self.release(old.alloc)
+
+    def retain_slots(self, data, slots):
+        """Count a reference more for the pointers in the given registers,
+        e.g., for the arguments of a called frame
+        """
+        for slot in slots:
+            if data[slot] is not None:
+                data[slot].alloc.refs += 1
+
+    def release_slots(self, data, slots):
+        for slot in slots:
+            if data[slot] is not None:
+                self.release(data[slot].alloc)
+
+    def release_frame(self, frame, result=None):
+        """Decrease the reference counts of the pointers going out of scope,
+        which are only the pointer variables of the function
+
+        result: returned pointer, whose reference moves to the caller
+        """
+        if result is not None:
+            result.alloc.refs += 1
+        self.release_slots(frame.data, frame.func.pointers)
+
+    def release(self, alloc):
+        alloc.refs -= 1
+        if alloc.refs == 0 and alloc.live:
+            self.reclaim(alloc)
+            print("Free memory:", alloc.site[1], file=self.out)
+
+    def reclaim(self, alloc):
+        alloc.live = False
+        self.allocations.remove(alloc)
+        self.heaps[alloc.heap].free(alloc.start)
+        if alloc.heap == POINTER_HEAP: # release the pointers it holds
+            cells = self.cells[POINTER_HEAP]
+            for addr in range(alloc.start, alloc.start + alloc.size):
+                if cells[addr] is not None:
+                    self.set_pointer(cells, addr, None)
 
     def detect_memory_leak(self):
-        for loc in range(MEMORY_SIZE):
-            if self.memory_usage[loc]:
-                raise RuntimeError("Memory leak at loc {}".format(loc))
+        """Report every allocation still live, which only takes a walk over
+        the live allocations, not over the heaps
+        """
+        if self.allocations:
+            leaks = sorted(self.allocations, key=lambda alloc: (alloc.site[0], alloc.site[2], alloc.start))
+            raise RuntimeError("Memory leak:\n" + "\n".join("  {}, {} cells at loc {}".format(alloc, alloc.size, alloc.start)
+                                                             for alloc in leaks))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process command line arguments')
     parser.add_argument('-f', dest='file', default="", help='get input file')
+    parser.add_argument('--engine', default="interp", choices=["interp", "pyjit"], help='execution engine')
+    parser.add_argument('--max-depth', dest='max_depth', type=int, default=MAX_STACK_DEPTH, help='maximum depth of the Bril call stack')
+    parser.add_argument('--batch', default="", help='run once per line of arguments in this file (needs NumPy)')
+    parser.add_argument('--profile', default="", help='write an execution profile to this file')
+    parser.add_argument('--memoize', dest='memo_size', type=int, default=0, help='cache up to this many results of pure functions')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='do not use the decoded program cache (.brilc)')
+    parser.add_argument('--alloc', default="best", choices=POLICIES, help='fit policy of the heap allocator')
+    parser.add_argument('--gc', default="refcount", choices=["refcount"] + list(COLLECTORS), help='garbage collector')
+    parser.add_argument('--heap', type=int, default=MEMORY_SIZE, help='initial cells of every heap')
+    parser.add_argument('--census', default="", help='write the live bytes of every allocation site over time to this file')
+    parser.add_argument('--census-every', dest='census_every', type=int, default=1000, help='allocations between two census samples')
+    parser.add_argument('--heap-stats', dest='heap_stats', action='store_true', help='report the heap usage and fragmentation')
     parser.add_argument('args', nargs='*')
     args = parser.parse_args()
+    MEMORY_SIZE = args.heap
     if args.file != "":
-        with open(args.file, "r") as infile:
-            program = json.load(infile)
-        input_args = sys.argv[3:]
+        program, funcs = load_program(args.file, args.cache)
     else:
         program = json.loads(''.join(sys.stdin.readlines())) # already in json format
-        input_args = sys.argv
+        funcs = None
 
-    bvm = VirtualMachine(program)
-    bvm.eval()
\ No newline at end of file
+    if args.batch != "":
+        from batch import run_batch
+        run_batch(program, VirtualMachine, args.batch, funcs)
+    else:
+        bvm = VirtualMachine(program, args.engine, args.max_depth, funcs=funcs, memo_size=args.memo_size,
+                             alloc_policy=args.alloc, gc=args.gc)
+        if args.census != "":
+            bvm.census = Census(args.census_every)
+        if args.profile != "":
+            profiler = Profiler(bvm)
+            profiler.eval(args.args)
+            profiler.dump(args.profile)
+        else:
+            bvm.eval(args.args)
+        if bvm.memo is not None:
+            bvm.memo.report()
+        if bvm.census is not None:
+            bvm.census.dump(args.census)
+        if args.heap_stats:
+            for kind, heap in enumerate(bvm.heaps):
+                if heap.num_allocs > 0:
+                    for key, value in heap.stats().items():
+                        print("heap {} {}: {}".format(HEAP_NAMES[kind], key, value), file=sys.stderr)
+            if bvm.collector is not None:
+                for key, value in bvm.collector.stats().items():
+                    print("gc {}: {}".format(key, value), file=sys.stderr)
\ No newline at end of file
@@ -0,0 +1,405 @@
+"""Decode Bril functions into a compact bytecode for the BVM.
+
+Every function is decoded once, the first time it is called, so that a
+large program where a run only calls a few functions starts quickly.
+Opcodes become small integers, variables become slot indices into the
+frame registers, and branch targets become program counters, so that the
+interpreter never touches the JSON dictionaries again.
+
+The interpreter runs a copy of the instructions where frequent pairs of
+adjacent instructions are fused into superinstructions (see fuse). The
+second instruction of a pair stays at its pc, so that every pc keeps its
+meaning for the tools working on the plain instructions.
+
+The code between a speculate and its commit is found when decoding (see
+mark_speculation): a speculate lists the registers its region may write,
+which it saves, and the stores of the region journal the cells they
+overwrite, so that a failing guard can undo the region.
+"""
+
+import operator
+
+# version of the decoded form, to be bumped whenever decoding changes so
+# that the programs cached on disk (see brilc.py) are decoded again
+BVM_VERSION = 5
+
+# opcodes
+CONST = 0
+ID = 1
+ADD = 2
+SUB = 3
+MUL = 4
+DIV = 5
+AND = 6
+OR = 7
+NEG = 8
+NOT = 9
+LT = 10
+GT = 11
+EQ = 12
+NE = 13
+LE = 14
+GE = 15
+JMP = 16
+BR = 17
+CALL = 18
+RET = 19
+PRINT = 20
+NOP = 21
+ALLOC = 22
+FREE = 23
+PTRADD = 24
+LOAD = 25
+STORE = 26
+SPECULATE = 27
+COMMIT = 28
+GUARD = 29
+FADD = 30
+FSUB = 31
+FMUL = 32
+FDIV = 33
+FEQ = 34
+FLT = 35
+FGT = 36
+FLE = 37
+FGE = 38
+END = 39 # implicit return at the end of a function
+UNKNOWN = 40
+# superinstructions, each fusing two adjacent instructions of a block
+CMP_BR = 41 # comparison feeding br
+BINARY_JMP = 42 # binary operation followed by jmp, e.g., a loop increment
+CONST_BINARY = 43 # const followed by a binary operation
+PTRADD_LOAD = 44 # ptradd feeding the address of load
+PTRADD_STORE = 45 # ptradd feeding the address of store
+NUM_OPCODES = 46
+
+OPCODES = {
+    "const": CONST, "id": ID,
+    "add": ADD, "sub": SUB, "mul": MUL, "div": DIV, "and": AND, "or": OR,
+    "neg": NEG, "not": NOT,
+    "lt": LT, "gt": GT, "eq": EQ, "ne": NE, "le": LE, "ge": GE,
+    "jmp": JMP, "br": BR, "call": CALL, "ret": RET, "print": PRINT, "nop": NOP,
+    "alloc": ALLOC, "free": FREE, "ptradd": PTRADD, "load": LOAD, "store": STORE,
+    "speculate": SPECULATE, "commit": COMMIT, "guard": GUARD,
+    "fadd": FADD, "fsub": FSUB, "fmul": FMUL, "fdiv": FDIV,
+    "feq": FEQ, "flt": FLT, "fgt": FGT, "fle": FLE, "fge": FGE,
+}
+
+UNARY_OPS = (ID, NEG, NOT, LOAD)
+BINARY_OPS = (ADD, SUB, MUL, DIV, AND, OR, LT, GT, EQ, NE, LE, GE,
+              FADD, FSUB, FMUL, FDIV, FEQ, FLT, FGT, FLE, FGE)
+COMPARE_OPS = (LT, GT, EQ, NE, LE, GE, FEQ, FLT, FGT, FLE, FGE)
+
+# heaps of the VM, by type of the cells (see heap.py)
+INT_HEAP = 0
+FLOAT_HEAP = 1
+BOOL_HEAP = 2
+POINTER_HEAP = 3
+OBJECT_HEAP = 4 # any other type
+NUM_HEAPS = 5
+
+
+def is_pointer(typ):
+    return isinstance(typ, dict) and "ptr" in typ
+
+
+def heap_of(typ):
+    """Return the heap holding the cells of the given type
+    """
+    if typ == "int":
+        return INT_HEAP
+    elif is_pointer(typ):
+        return POINTER_HEAP
+    elif typ == "float":
+        return FLOAT_HEAP
+    elif typ == "bool":
+        return BOOL_HEAP
+    return OBJECT_HEAP
+
+
+def pointee_heap(typ):
+    """Return the heap of the memory a pointer of the given type points to
+    """
+    if is_pointer(typ):
+        return heap_of(typ["ptr"])
+    return INT_HEAP # untyped
+
+
+def int_div(a, b):
+    """Bril's int division, which truncates toward zero like C
+    """
+    return a // b if (a >= 0) == (b > 0) else -(-a // b)
+
+
+# Python functions of the binary operations, used by the superinstructions
+BINARY_FUNCS = {
+    ADD: operator.add, SUB: operator.sub, MUL: operator.mul, DIV: int_div,
+    AND: operator.and_, OR: operator.or_,
+    LT: operator.lt, GT: operator.gt, EQ: operator.eq, NE: operator.ne, LE: operator.le, GE: operator.ge,
+    FADD: operator.add, FSUB: operator.sub, FMUL: operator.mul, FDIV: operator.truediv,
+    FEQ: operator.eq, FLT: operator.lt, FGT: operator.gt, FLE: operator.le, FGE: operator.ge,
+}
+
+
+class Function(object):
+    """The decoded form of a Bril function
+
+    instrs: decoded instructions, one tuple per pc, starting with the opcode
+    code: instrs with superinstructions, run by the interpreter
+    source: original JSON instruction of each pc
+    slots: maps from variable name to register index
+    types: maps from variable name to its Bril type
+    labels: maps from label name to pc
+    locals: initial registers of the non-parameter slots
+    pointers: slots of the pointer variables, which are released at return
+    pointer_args: slots of the pointer parameters
+    blocks: compiled blocks of the pyjit engine, indexed by pc
+    """
+
+    def __init__(self, func) -> None:
+        self.name = func["name"]
+        self.args = func.get("args", [])
+        self.slots = {}
+        self.types = {}
+        self.labels = {}
+        self.source = []
+        for arg in self.args:
+            self.slot(arg["name"])
+            self.types[arg["name"]] = arg["type"]
+        for instr in func["instrs"]:
+            if "label" in instr:
+                self.labels[instr["label"]] = len(self.source)
+            else:
+                self.source.append(instr)
+                if "dest" in instr:
+                    self.types[instr["dest"]] = instr.get("type")
+        self.instrs = [self.decode(instr, pc) for pc, instr in enumerate(self.source)]
+        # implicit return
+        self.source.append(None)
+        self.instrs.append((END,))
+        if any(instr[0] == SPECULATE for instr in self.instrs):
+            pointers = set(slot for var, slot in self.slots.items() if is_pointer(self.types.get(var)))
+            self.instrs = mark_speculation(self.instrs, pointers)
+        self.finish()
+
+    def finish(self):
+        """Build what derives from the decoded instructions
+        """
+        self.code = fuse(self.instrs, set(self.labels.values()))
+        self.names = list(self.slots)
+        self.locals = [None] * (len(self.slots) - len(self.args))
+        self.pointers = [slot for var, slot in self.slots.items() if is_pointer(self.types.get(var))]
+        self.pointer_args = [slot for slot in self.pointers if slot < len(self.args)]
+        self.blocks = None
+
+    def save(self):
+        """Return the decoded function as plain data, which marshal can store
+        """
+        return (self.name, self.args, self.slots, self.types, self.labels, self.source, self.instrs)
+
+    @staticmethod
+    def load(data):
+        """Rebuild a decoded function from the result of save
+        """
+        func = Function.__new__(Function)
+        func.name, func.args, func.slots, func.types, func.labels, func.source, func.instrs = data
+        func.finish()
+        return func
+
+    def slot(self, var):
+        if var not in self.slots:
+            self.slots[var] = len(self.slots)
+        return self.slots[var]
+
+    def decode(self, instr, pc):
+        op = OPCODES.get(instr["op"], UNKNOWN)
+        args = [self.slot(arg) for arg in instr.get("args", [])]
+        labels = [self.labels[label] for label in instr.get("labels", [])]
+        dest = self.slot(instr["dest"]) if "dest" in instr else -1
+        if op == CONST:
+            return (op, dest, instr["value"])
+        elif op == ID:
+            # pointers are counted by the VM
+            return (op, dest, args[0], is_pointer(instr.get("type")))
+        elif op == LOAD:
+            return (op, dest, args[0], heap_of(instr["type"]))
+        elif op in UNARY_OPS:
+            return (op, dest, args[0])
+        elif op in BINARY_OPS or op == PTRADD:
+            return (op, dest, args[0], args[1])
+        elif op == JMP:
+            return (op, labels[0])
+        elif op == BR:
+            return (op, args[0], labels[0], labels[1])
+        elif op == GUARD:
+            return (op, args[0], labels[0])
+        elif op == CALL:
+            return (op, dest, instr["funcs"][0], tuple(args))
+        elif op == RET:
+            if args:
+                return (op, args[0], is_pointer(self.types.get(instr["args"][0])))
+            return (op, -1, False)
+        elif op == PRINT:
+            return (op, args[0])
+        elif op == ALLOC:
+            # (function, variable, pc) of the allocation site
+            return (op, dest, args[0], (self.name, instr["dest"], pc), pointee_heap(instr["type"]))
+        elif op == FREE:
+            return (op, args[0])
+        elif op == STORE:
+            # not journaled, unless it is in a speculative region
+            return (op, args[0], args[1], pointee_heap(self.types.get(instr["args"][0])), False)
+        elif op == UNKNOWN:
+            return (op, instr["op"])
+        return (op,)
+
+
+# ops whose decoded form writes the register instr[1], unless it is -1
+DEST_OPS = (CONST, ID, NEG, NOT, LOAD, PTRADD, ALLOC, CALL) + BINARY_OPS
+
+
+def speculative_region(instrs, start):
+    """Return the pcs that may run in the speculation of the speculate at
+    pc start, i.e., up to its commit or to a failing guard
+
+    A nested speculation is part of the region, and so is the target of
+    its guards, which abort the inner speculation only.
+    """
+    nested = sum(1 for instr in instrs if instr[0] == SPECULATE)
+    region = set()
+    seen = set()
+    todo = [(start + 1, 0)] # (pc, depth of the nested speculations)
+    while todo:
+        pc, depth = todo.pop()
+        if (pc, depth) in seen or pc >= len(instrs):
+            continue
+        seen.add((pc, depth))
+        region.add(pc)
+        instr = instrs[pc]
+        op = instr[0]
+        if op == COMMIT:
+            if depth > 0:
+                todo.append((pc + 1, depth - 1))
+        elif op == SPECULATE:
+            # a speculate in a loop nests no deeper than the static count
+            todo.append((pc + 1, min(depth + 1, nested)))
+        elif op == JMP:
+            todo.append((instr[1], depth))
+        elif op == BR:
+            todo += [(instr[2], depth), (instr[3], depth)]
+        elif op == GUARD:
+            todo.append((pc + 1, depth))
+            if depth > 0:
+                todo.append((instr[2], depth - 1))
+        elif op not in (RET, END):
+            todo.append((pc + 1, depth))
+    return region
+
+
+def mark_speculation(instrs, pointers):
+    """Return a copy of instrs where every speculate lists the registers
+    that its region may write, as (SPECULATE, slots, pointer slots), and
+    every store of a region is journaled
+
+    pointers: slots of the pointer registers
+    """
+    instrs = list(instrs)
+    journaled = set()
+    for pc, instr in enumerate(instrs):
+        if instr[0] == SPECULATE:
+            region = speculative_region(instrs, pc)
+            journaled |= region
+            slots = set(instrs[i][1] for i in region if instrs[i][0] in DEST_OPS and instrs[i][1] >= 0)
+            instrs[pc] = (SPECULATE, tuple(sorted(slots)), tuple(sorted(slots & pointers)))
+    for pc in journaled:
+        if instrs[pc][0] == STORE:
+            instrs[pc] = instrs[pc][:4] + (True,)
+    return instrs
+
+
+def fuse_pair(first, second):
+    """Return the superinstruction doing first and then second, or None
+    """
+    op, next_op = first[0], second[0]
+    if op in COMPARE_OPS and next_op == BR and second[1] == first[1]:
+        return (CMP_BR, BINARY_FUNCS[op], first[1], first[2], first[3], second[2], second[3])
+    elif op in BINARY_OPS and next_op == JMP:
+        return (BINARY_JMP, BINARY_FUNCS[op], first[1], first[2], first[3], second[1])
+    elif op == CONST and next_op in BINARY_OPS:
+        return (CONST_BINARY, first[1], first[2], BINARY_FUNCS[next_op], second[1], second[2], second[3])
+    elif op == PTRADD and next_op == LOAD and second[2] == first[1]:
+        return (PTRADD_LOAD, first[1], first[2], first[3], second[1], second[3])
+    elif op == PTRADD and next_op == STORE and second[1] == first[1]:
+        return (PTRADD_STORE, first[1], first[2], first[3], second[2], second[3], second[4])
+    return None
+
+
+def fuse(instrs, leaders):
+    """Return a copy of instrs where the first instruction of every fused
+    pair is replaced by its superinstruction
+
+    The pairs were picked from the adjacent pairs executed most often by
+    the test programs. A pair never crosses a block boundary, so nothing
+    jumps to its second instruction.
+    """
+    code = list(instrs)
+    pc = 0
+    while pc + 1 < len(instrs):
+        fused = None
+        if pc + 1 not in leaders:
+            fused = fuse_pair(instrs[pc], instrs[pc + 1])
+        if fused is not None:
+            code[pc] = fused
+            pc += 2
+        else:
+            pc += 1
+    return code
+
+
+class Frame(object):
+    __slots__ = ("func", "instrs", "data", "pc", "dest")
+
+    def __init__(self, func, args) -> None:
+        """
+        func: decoded function, shared by all its activations
+        args: values of the parameters, which occupy the first slots
+        pc: where to resume when the frame is suspended by a call
+        dest: slot receiving the result of that call (-1 if none)
+        """
+        self.func = func
+        self.instrs = func.code
+        self.data = args + func.locals
+        self.pc = 0
+        self.dest = -1
+
+
+class FunctionTable(dict):
+    """Decoded functions indexed by name, where a function is only decoded
+    the first time it is looked up, e.g., by its first call
+
+    names: names of all the functions of the program
+    decode: function from a name to the decoded function, raising KeyError
+            for an unknown name
+    """
+
+    def __init__(self, names, decode) -> None:
+        super().__init__()
+        self.names = list(names)
+        self.decode = decode
+
+    def __missing__(self, name):
+        func = self[name] = self.decode(name)
+        return func
+
+    def decode_all(self):
+        """Return all the decoded functions, in the order of the program
+        """
+        return [self[name] for name in self.names]
+
+
+def decode_program(program):
+    """Return the functions of a Bril program, indexed by name and decoded
+    on demand
+    """
+    sources = {func["name"]: func for func in program["functions"]}
+    return FunctionTable(sources, lambda name: Function(sources[name]))
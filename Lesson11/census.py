@@ -0,0 +1,60 @@
+"""Heap census of the BVM
+
+    python3 bvm.py --census census.json --census-every 100 -f test/bubblesort.json 5 10 7 5 1 3
+
+Every N allocations, the census counts the live bytes of every allocation
+site from the table of live allocations of the VM, so that a sample costs
+as much as the number of live allocations, whatever the size of the heaps.
+Sites whose bytes keep growing from sample to sample point to memory
+growth in a long run. The census is a JSON file of the form
+
+    {"every": 100,
+     "samples": [{"allocs": 100, "time": 0.0012, # seconds since the start
+                  "sites": [{"func": "main", "var": "array", "pc": 12,
+                             "allocations": 1, "bytes": 40}, ...]}, ...]}
+
+where allocs counts all the allocations so far, and the sites of a sample
+are sorted by decreasing bytes.
+"""
+
+import json
+import time
+from heap import CELL_BYTES
+
+
+class Census(object):
+
+    def __init__(self, every) -> None:
+        """
+        every: number of allocations between two samples
+        """
+        self.every = every
+        self.countdown = every
+        self.samples = []
+        self.start = time.perf_counter()
+
+    def count(self, vm):
+        """Called by the VM after every allocation
+        """
+        self.countdown -= 1
+        if self.countdown == 0:
+            self.countdown = self.every
+            self.sample(vm)
+
+    def sample(self, vm):
+        sites = {} # site->[allocations, bytes]
+        for alloc in vm.allocations:
+            entry = sites.get(alloc.site)
+            if entry is None:
+                entry = sites[alloc.site] = [0, 0]
+            entry[0] += 1
+            entry[1] += alloc.size * CELL_BYTES[alloc.heap]
+        self.samples.append({
+            "allocs": sum(heap.num_allocs for heap in vm.heaps),
+            "time": time.perf_counter() - self.start,
+            "sites": [{"func": func, "var": var, "pc": pc, "allocations": num, "bytes": size}
+                      for (func, var, pc), (num, size) in sorted(sites.items(), key=lambda item: -item[1][1])]})
+
+    def dump(self, filename):
+        with open(filename, "w") as outfile:
+            outfile.write(json.dumps({"every": self.every, "samples": self.samples}, indent=2))
@@ -0,0 +1,151 @@
+"""Tracing garbage collectors of the BVM
+
+    python3 bvm.py --gc marksweep -f test/bubblesort.json 5 10 7 5 1 3
+
+By default, the VM counts the references to every allocation on each
+pointer write, and reclaims an allocation as soon as its count drops to
+zero. A tracing collector instead lets the program write its pointers as
+plain values, and finds the live allocations in bulk, only when a heap
+fills up. The roots are the pointer registers of the frames on the call
+stack, known from the static types of their functions (Function.pointers),
+and the pointer cells of the reachable allocations are traced from there.
+
+A collection runs when an alloc would take the cells in use of its heap
+past the threshold of that heap, which is then set to GROWTH times the
+cells still in use, so that the cost of a collection is amortized over
+as many allocations as there are live cells.
+
+"marksweep" puts the unreachable allocations back into the free lists of
+the heaps (see heap.py), where the reachable ones stay in place.
+"copying" allocates by bumping a pointer in a SemiSpace per heap, and
+copies the reachable allocations to the start of a new space at every
+collection, updating the pointers to them, so that the free cells always
+form one block at the end.
+"""
+
+import time
+from bytecode import *
+from heap import Heap, SemiSpace
+
+GROWTH = 2
+
+
+def store_pointer(data, index, ptr):
+    """Replacement of VirtualMachine.set_pointer, without reference counts
+    """
+    data[index] = ptr
+
+def ignore(*args):
+    pass
+
+
+class MarkSweep(object):
+
+    def __init__(self, vm) -> None:
+        self.vm = vm
+
+    def new_heaps(self, size, policy):
+        """Return the heaps of a new run, and reset the thresholds
+        """
+        self.initial = size
+        self.thresholds = [size] * NUM_HEAPS
+        self.num_collections = 0
+        self.num_reclaimed = 0 # allocations
+        self.time = 0.0
+        return [Heap(size, policy, kind) for kind in range(NUM_HEAPS)]
+
+    def roots(self):
+        """Yield the pointers in the registers of the frames on the stack
+        """
+        vm = self.vm
+        frames = vm.stack + [vm.frame] if vm.frame is not None else vm.stack
+        for frame in frames:
+            data = frame.data
+            for slot in frame.func.pointers:
+                if data[slot] is not None:
+                    yield data[slot]
+
+    def mark(self):
+        """Return the reachable allocations, in the order they are found
+        """
+        cells = self.vm.cells
+        reached = {} # allocation->None, as an ordered set
+        todo = []
+        for ptr in self.roots():
+            if ptr.alloc not in reached and ptr.alloc.live: # not dangling
+                reached[ptr.alloc] = None
+                todo.append(ptr.alloc)
+        while todo:
+            alloc = todo.pop()
+            if alloc.heap != POINTER_HEAP:
+                continue
+            for ptr in cells[POINTER_HEAP][alloc.start:alloc.start + alloc.size]:
+                if ptr is not None and ptr.alloc not in reached and ptr.alloc.live:
+                    reached[ptr.alloc] = None
+                    todo.append(ptr.alloc)
+        return list(reached)
+
+    def collect(self, kind=OBJECT_HEAP, size=0):
+        """Reclaim the unreachable allocations of all the heaps
+
+        kind, size: pending alloc, which the new threshold of its heap
+                    leaves room for
+        """
+        vm = self.vm
+        start = time.perf_counter()
+        live = self.mark()
+        dead = vm.allocations.difference(live)
+        self.reclaim(live, dead)
+        for alloc in sorted(dead, key=lambda alloc: (alloc.heap, alloc.start)):
+            print("Free memory:", alloc.site[1], file=vm.out)
+        for heap_kind, heap in enumerate(vm.heaps):
+            used = heap.used + size if heap_kind == kind else heap.used
+            self.thresholds[heap_kind] = max(self.initial, GROWTH * used)
+        self.num_collections += 1
+        self.num_reclaimed += len(dead)
+        self.time += time.perf_counter() - start
+
+    def reclaim(self, live, dead):
+        for alloc in dead:
+            alloc.live = False
+            self.vm.allocations.remove(alloc)
+            self.vm.heaps[alloc.heap].free(alloc.start)
+
+    def stats(self):
+        return {"collections": self.num_collections, "reclaimed": self.num_reclaimed, "time": self.time}
+
+
+class Copying(MarkSweep):
+
+    def new_heaps(self, size, policy):
+        MarkSweep.new_heaps(self, size, policy)
+        return [SemiSpace(size, kind) for kind in range(NUM_HEAPS)]
+
+    def reclaim(self, live, dead):
+        vm = self.vm
+        for alloc in dead:
+            alloc.live = False
+        vm.allocations = set(live)
+        # copy the allocations of every heap, and remember how far they move
+        moved = {}
+        for kind, heap in enumerate(vm.heaps):
+            allocs = [alloc for alloc in live if alloc.heap == kind]
+            starts = heap.flip([(alloc.start, alloc.size) for alloc in allocs])
+            for alloc, start in zip(allocs, starts):
+                moved[alloc] = start - alloc.start
+                alloc.start = start
+            vm.cells[kind] = heap.cells
+        # a Pointer may be shared by several registers and cells
+        seen = set()
+        cells = vm.cells[POINTER_HEAP]
+        pointers = list(self.roots())
+        for alloc in live:
+            if alloc.heap == POINTER_HEAP:
+                pointers += [ptr for ptr in cells[alloc.start:alloc.start + alloc.size] if ptr is not None]
+        for ptr in pointers:
+            if ptr.alloc in moved and id(ptr) not in seen:
+                seen.add(id(ptr))
+                ptr.addr += moved[ptr.alloc]
+
+
+COLLECTORS = {"marksweep": MarkSweep, "copying": Copying}
@@ -0,0 +1,306 @@
+"""Free-list allocator of the memory cells of the BVM
+
+The free blocks of the heap are kept in size-segregated bins, where bin k
+holds the blocks of 2**k to 2**(k+1)-1 cells, i.e., of k+1 bits. An allocation looks for a block in the bin of its size, and
+then in the larger bins, where any block fits. With the "first" policy
+the first fitting block found is taken, and with the "best" policy the
+smallest one. The rest of the block stays free.
+
+A freed block, whether freed by the program or by the reference counter,
+is merged with the free blocks right before and after it, which are found
+in constant time from the maps of the free blocks by start and by end.
+
+The VM has one heap per type of cells (see heap_of in bytecode.py), whose
+cells are stored in an array of 64-bit ints, of doubles or of bytes, or in
+a list for pointers and the other types. A heap moves its cells to a list
+the first time a value does not fit its array, e.g., an int beyond 64
+bits, which the registers hold like any other int. Only the allocated
+blocks are tracked, so alloc and free do not depend on the size of the
+block, besides zeroing the cells of a new block. A heap without a large
+enough free block grows, at least doubling its size, so there is no limit
+on the memory but the one of the host.
+
+A pointer of the program is a Pointer to a cell of an Allocation, which
+counts the registers and pointer cells referencing it (see bvm.py).
+
+With the copying collector (see collector.py), every heap is a SemiSpace
+instead, which allocates by bumping a pointer and only reclaims memory
+when the collector copies the live blocks to a new space.
+"""
+
+from array import array
+from bytecode import *
+
+POLICIES = ["first", "best"]
+
+
+class BoolArray(array):
+    """Array of bytes holding bools, which loads them as bools, while a
+    slice stays an array of bytes to copy blocks with
+    """
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return array.__getitem__(self, index)
+        return array.__getitem__(self, index) != 0
+
+
+HEAP_NAMES = {INT_HEAP: "int", FLOAT_HEAP: "float", BOOL_HEAP: "bool", POINTER_HEAP: "ptr", OBJECT_HEAP: "object"}
+
+# the cells of every heap, whose zero is the initial value of a cell
+CELLS = {
+    INT_HEAP: lambda size: array("q", bytes(8 * size)),
+    FLOAT_HEAP: lambda size: array("d", bytes(8 * size)),
+    BOOL_HEAP: lambda size: BoolArray("b", bytes(size)),
+    POINTER_HEAP: lambda size: [None] * size,
+    OBJECT_HEAP: lambda size: [0] * size,
+}
+
+# bytes of a cell of every heap, where pointers and objects take a word
+CELL_BYTES = {INT_HEAP: 8, FLOAT_HEAP: 8, BOOL_HEAP: 1, POINTER_HEAP: 8, OBJECT_HEAP: 8}
+
+
+class Allocation(object):
+    """A block allocated by the program, with its reference count
+
+    site: (function, variable, pc) of the alloc instruction
+    live: False once the block is freed
+    """
+    __slots__ = ("heap", "start", "size", "refs", "site", "live")
+
+    def __init__(self, heap, start, size, site) -> None:
+        self.heap = heap
+        self.start = start
+        self.size = size
+        self.refs = 0
+        self.site = site
+        self.live = True
+
+    def __str__(self):
+        return "{} allocated in @{} at pc {}".format(self.site[1], self.site[0], self.site[2])
+
+
+class Pointer(object):
+    """A pointer to the cell at addr of the heap of alloc
+
+    Pointers derived by ptradd keep their allocation, so that all the
+    aliases of a block count its references.
+    """
+    __slots__ = ("alloc", "addr")
+
+    def __init__(self, alloc, addr) -> None:
+        self.alloc = alloc
+        self.addr = addr
+
+    def __add__(self, offset):
+        return Pointer(self.alloc, self.addr + offset)
+
+    def __str__(self):
+        return str(self.addr)
+
+    __repr__ = __str__
+
+
+class Heap(object):
+    """Allocator of the cells 0 to size-1, which grows on demand
+
+    policy: "first" or "best" fit in the bins
+    kind: which of the heaps of bytecode.py, giving the type of the cells
+    """
+
+    def __init__(self, size, policy="best", kind=OBJECT_HEAP) -> None:
+        if policy not in POLICIES:
+            raise RuntimeError("Unknown allocation policy {}".format(policy))
+        self.size = size
+        self.policy = policy
+        self.new_cells = CELLS[kind]
+        self.cells = self.new_cells(size)
+        self.blocks = {} # start->size of the allocated blocks
+        self.free_start = {} # start->size of the free blocks
+        self.free_end = {} # end->start of the free blocks
+        # starts of the free blocks, in order of insertion, by size class
+        self.bins = [{} for _ in range(size.bit_length())]
+        # statistics
+        self.used = 0
+        self.peak = 0 # most cells in use at once
+        self.top = 0 # end of the highest block ever allocated
+        self.num_allocs = 0
+        self.num_frees = 0
+        self.insert(0, size)
+
+    def insert(self, start, size):
+        self.free_start[start] = size
+        self.free_end[start + size] = start
+        self.bins[size.bit_length() - 1][start] = None
+
+    def remove(self, start):
+        size = self.free_start.pop(start)
+        del self.free_end[start + size]
+        del self.bins[size.bit_length() - 1][start]
+        return size
+
+    def find(self, size):
+        """Return the start of a free block of at least size cells, or None
+        """
+        cls = size.bit_length() - 1
+        if cls >= len(self.bins): # larger than the heap
+            return None
+        best = None
+        # the bin of the size may hold smaller blocks
+        for start in self.bins[cls]:
+            block = self.free_start[start]
+            if block >= size:
+                if self.policy == "first" or block == size:
+                    return start
+                if best is None or block < self.free_start[best]:
+                    best = start
+        if best is not None:
+            return best
+        for blocks in self.bins[cls + 1:]:
+            if blocks:
+                if self.policy == "first":
+                    return next(iter(blocks))
+                return min(blocks, key=self.free_start.__getitem__)
+        return None
+
+    def alloc(self, size):
+        """Return the address of a new block of size cells
+        """
+        if size < 1:
+            raise RuntimeError("Invalid allocation of {} cells".format(size))
+        start = self.find(size)
+        if start is None:
+            self.grow(size)
+            start = self.find(size)
+        block = self.remove(start)
+        if block > size:
+            self.insert(start + size, block - size)
+        self.blocks[start] = size
+        self.used += size
+        self.peak = max(self.peak, self.used)
+        self.top = max(self.top, start + size)
+        self.num_allocs += 1
+        self.cells[start:start + size] = self.new_cells(size)
+        return start
+
+    def widen(self):
+        """Keep the cells in a list from now on
+        """
+        zero = self.new_cells(1)[0]
+        self.cells = list(self.cells)
+        self.new_cells = lambda size: [zero] * size
+
+    def grow(self, size):
+        """Add at least size free cells at the end of the heap
+        """
+        old = self.size
+        self.size = max(2 * old, old + size)
+        self.cells.extend(self.new_cells(self.size - old))
+        while len(self.bins) < self.size.bit_length():
+            self.bins.append({})
+        start = old
+        if old in self.free_end: # merge with the last free block
+            start = self.free_end[old]
+            self.remove(start)
+        self.insert(start, self.size - start)
+
+    def free(self, ptr):
+        """Release the block starting at ptr and merge it with its free
+        neighbors
+        """
+        size = self.blocks.pop(ptr, None)
+        if size is None:
+            raise RuntimeError("Double free")
+        self.used -= size
+        self.num_frees += 1
+        start, end = ptr, ptr + size
+        if start in self.free_end: # free block right before
+            start = self.free_end[start]
+            self.remove(start)
+        if end in self.free_start: # free block right after
+            end += self.remove(end)
+        self.insert(start, end - start)
+
+    def stats(self):
+        """Return the usage and fragmentation statistics of the heap
+
+        The fragmentation is the share of the free cells that are not in
+        the largest free block, i.e., 0 when all the free cells are in one
+        block.
+        """
+        free = self.size - self.used
+        largest = max(self.free_start.values(), default=0)
+        return {"size": self.size, "used": self.used, "peak": self.peak, "top": self.top,
+                "allocs": self.num_allocs, "frees": self.num_frees,
+                "free_blocks": len(self.free_start), "largest_free_block": largest,
+                "fragmentation": 1 - largest / free if free > 0 else 0.0}
+
+
+class SemiSpace(object):
+    """Bump allocator of the cells 0 to size-1, which grows on demand
+
+    The cells past the bump pointer are never used yet, so they are still
+    zero and a new block needs no clearing. A freed block stays in the
+    space until the next collection leaves it behind (see flip).
+    """
+
+    def __init__(self, size, kind=OBJECT_HEAP) -> None:
+        self.size = size
+        self.new_cells = CELLS[kind]
+        self.cells = self.new_cells(size)
+        # statistics
+        self.used = 0 # the bump pointer, so freed blocks count until a flip
+        self.peak = 0
+        self.top = 0
+        self.num_allocs = 0
+        self.num_frees = 0
+        self.num_copied = 0 # cells copied by the collections
+
+    def alloc(self, size):
+        """Return the address of a new block of size cells
+        """
+        if size < 1:
+            raise RuntimeError("Invalid allocation of {} cells".format(size))
+        start = self.used
+        if start + size > self.size:
+            self.grow(size)
+        self.used = start + size
+        self.peak = max(self.peak, self.used)
+        self.top = self.peak
+        self.num_allocs += 1
+        return start
+
+    def grow(self, size):
+        old = self.size
+        self.size = max(2 * old, old + size)
+        self.cells.extend(self.new_cells(self.size - old))
+
+    def free(self, ptr):
+        self.num_frees += 1 # reclaimed by the next flip
+
+    widen = Heap.widen
+
+    def flip(self, blocks):
+        """Copy the given (start, size) blocks, in order, to the start of a
+        new space replacing the current one, and return their new starts
+        """
+        cells = self.cells
+        new_cells = self.new_cells(self.size)
+        starts = []
+        top = 0
+        for start, size in blocks:
+            new_cells[top:top + size] = cells[start:start + size]
+            starts.append(top)
+            top += size
+        self.cells = new_cells
+        self.used = top
+        self.num_copied += top
+        return starts
+
+    def stats(self):
+        """Return the usage statistics of the space, whose free cells are
+        all in one block at the end
+        """
+        return {"size": self.size, "used": self.used, "peak": self.peak, "top": self.top,
+                "allocs": self.num_allocs, "frees": self.num_frees, "copied": self.num_copied,
+                "largest_free_block": self.size - self.used}
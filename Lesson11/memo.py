@@ -0,0 +1,133 @@
+"""Memoization of the calls to pure Bril functions
+
+A function is pure when it has no print, no memory instruction (alloc,
+free, store, load), no speculation instruction, no pointer argument or
+result, and only calls pure functions. Its result then only depends on
+its arguments, so the calls to it go through a cache keyed by the
+arguments, bounded in size with LRU eviction. A hit skips the whole
+call, which is counted as a single instruction.
+"""
+
+import sys
+from collections import OrderedDict
+from bytecode import *
+from ops import HANDLERS, call, ret, end
+
+IMPURE_OPS = ["print", "alloc", "free", "store", "load", "speculate", "commit", "guard"]
+
+
+def pure_functions(headers, funcs, names, checked=(), pure=()):
+    """Return the names of the pure functions among the given ones and the
+    functions they may call, and the names of all the functions checked
+
+    headers: name->Bril function of the program, which may lack its
+             instructions (see brilc.py)
+    funcs: decoded functions of the program, whose source instructions are
+           read, so that only the functions checked get decoded
+    checked: names of the functions checked before, which are not again
+    pure: names of the pure functions among them
+    """
+    found = set()
+    callees = {}
+    seen = set()
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name in checked or name in seen:
+            continue
+        seen.add(name)
+        func = headers.get(name)
+        if func is None or name == "main" or is_pointer(func.get("type")) or \
+           any(is_pointer(arg["type"]) for arg in func.get("args", [])):
+            continue
+        source = funcs[name].source[:-1] # without the implicit return
+        ops = [instr["op"] for instr in source]
+        if any(op in IMPURE_OPS or op not in OPCODES for op in ops):
+            continue
+        found.add(name)
+        callees[name] = set(instr["funcs"][0] for instr in source if instr["op"] == "call")
+        todo.extend(callees[name])
+    # a function calling an impure one is impure, until nothing changes
+    changed = True
+    while changed:
+        changed = False
+        for name in list(found):
+            if not callees[name] <= found | pure:
+                found.remove(name)
+                changed = True
+    return found, seen
+
+
+class Memoizer(object):
+    """Cache of the results of the pure functions of a program
+
+    The purity of a function is checked on its first call, with the
+    functions it may call, so the others are never decoded.
+
+    size: maximum number of cached results
+    """
+
+    def __init__(self, program, funcs, size) -> None:
+        self.headers = {func["name"]: func for func in program["functions"]}
+        self.funcs = funcs
+        self.checked = set() # names of the functions whose purity is known
+        self.pure = set() # names of the pure ones
+        self.size = size
+        self.cache = OrderedDict() # (name, args, arg types)->result
+        self.stats = {} # name->[hits, misses] of the pure functions checked
+        self.keys = [] # keys of the running calls to pure functions
+        # the interpreter handlers, with memoized calls and returns
+        self.handlers = list(HANDLERS)
+        self.handlers[CALL] = memo_call
+        self.handlers[RET] = memo_ret
+        self.handlers[END] = memo_end
+
+    def check(self, name):
+        """Check the purity of the function name and of the functions it may
+        call, which were not checked yet
+        """
+        pure, checked = pure_functions(self.headers, self.funcs, [name], self.checked, self.pure)
+        self.checked |= checked
+        self.pure |= pure
+        for name in pure:
+            self.stats[name] = [0, 0]
+
+    def store(self, value):
+        self.cache[self.keys.pop()] = value
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False) # least recently used
+
+    def report(self, outfile=sys.stderr):
+        for name, (hits, misses) in sorted(self.stats.items()):
+            print("memo {}: {} hits, {} misses".format(name, hits, misses), file=outfile)
+
+
+def memo_call(vm, frame, instr, pc):
+    memo = vm.memo
+    name = instr[2]
+    if name not in memo.checked:
+        memo.check(name)
+    if name in memo.pure:
+        data = frame.data
+        args = tuple([data[arg] for arg in instr[3]])
+        # True, 1 and 1.0 are equal keys, but may give different results
+        key = (name, args, tuple(map(type, args)))
+        if key in memo.cache:
+            memo.cache.move_to_end(key)
+            memo.stats[name][0] += 1
+            if instr[1] >= 0:
+                data[instr[1]] = memo.cache[key]
+            return pc
+        memo.stats[name][1] += 1
+        memo.keys.append(key)
+    return call(vm, frame, instr, pc)
+
+def memo_ret(vm, frame, instr, pc):
+    if frame.func.name in vm.memo.pure:
+        vm.memo.store(frame.data[instr[1]] if instr[1] >= 0 else None)
+    return ret(vm, frame, instr, pc)
+
+def memo_end(vm, frame, instr, pc):
+    if frame.func.name in vm.memo.pure:
+        vm.memo.store(None)
+    return end(vm, frame, instr, pc)
@@ -0,0 +1,157 @@
+"""Redundant load and dead store elimination
+
+    python3 memopt.py test/mem.json | python3 bvm.py
+
+Loads are replaced by an id of the value last stored or loaded through the
+same pointer variable when the cell cannot have changed since, which is
+found by a forward dataflow analysis of the available (pointer, value)
+pairs over the CFG. A store kills the pairs whose pointer may alias it
+according to the alias analysis, so that a store into one array does not
+forget the elements loaded from another, and a call kills all the pairs
+but those of the allocations that never leave the function. Redefining a
+variable kills the pairs it appears in.
+
+A store is deleted when the cell is known to hold the value already, or
+when the same pointer variable is stored again later in the block before
+any load that may alias it, any call or free, and the end of the block.
+"""
+
+import sys
+import json
+from alias import AliasAnalysis
+from sroa import form_blocks
+
+SIDE_EFFECT_FREE = ["const", "id", "add", "sub", "mul", "div", "and", "or", "not",
+                    "eq", "lt", "gt", "le", "ge", "ne", "neg",
+                    "fadd", "fsub", "fmul", "fdiv", "feq", "flt", "fgt", "fle", "fge",
+                    "alloc", "ptradd", "print", "nop", "jmp", "br"]
+
+
+def split_blocks(instrs):
+    """Return the instruction indices of every block and the predecessors
+    of every block
+    """
+    block_of, succs = form_blocks(instrs)
+    blocks = [[] for _ in range(block_of[-1] + 1)] if instrs else []
+    for i, block in enumerate(block_of):
+        blocks[block].append(i)
+    preds = [[] for _ in blocks]
+    for block, targets in succs.items():
+        for succ in targets:
+            if succ < len(blocks):
+                preds[succ].append(block)
+    return blocks, preds
+
+
+def kill_var(facts, var):
+    return {(ptr, val) for ptr, val in facts if var not in (ptr, val)}
+
+
+def transfer(instr, facts, aa, rewrite=None):
+    """Return the available pairs after instr, and the instructions that
+    replace it in rewrite
+    """
+    op = instr.get("op")
+    args = instr.get("args", [])
+    replacement = [instr]
+    if op == "load":
+        known = [val for ptr, val in facts if ptr == args[0]]
+        if known:
+            value = min(known)
+            replacement = [] if value == instr["dest"] else \
+                [{"op": "id", "dest": instr["dest"], "type": instr["type"], "args": [value]}]
+    elif op == "store" and (args[0], args[1]) in facts:
+        replacement = [] # the cell already holds the value
+    elif op in ["store", "free"]:
+        facts = {(ptr, val) for ptr, val in facts if not aa.may_alias(ptr, args[0])}
+    elif op == "call":
+        facts = {(ptr, val) for ptr, val in facts if aa.is_local(ptr)}
+    elif op is not None and op not in SIDE_EFFECT_FREE:
+        facts = set()
+    if "dest" in instr:
+        if replacement:
+            facts = kill_var(facts, instr["dest"])
+        if op == "load" and instr["dest"] != args[0]:
+            facts.add((args[0], instr["dest"]))
+    if op == "store" and args[1] != args[0]:
+        facts.add((args[0], args[1]))
+    if rewrite is not None:
+        rewrite += replacement
+    return facts
+
+
+def forward_loads(func, aa):
+    instrs = func["instrs"]
+    blocks, preds = split_blocks(instrs)
+    universe = None # top: all the pairs
+    out = [universe] * len(blocks)
+    def block_in(b):
+        if b == 0:
+            return set()
+        ins = [out[p] for p in preds[b] if out[p] is not None]
+        if not ins:
+            return set() if not preds[b] else universe
+        return set.intersection(*ins)
+    worklist = list(range(len(blocks)))
+    while worklist:
+        b = worklist.pop(0)
+        facts = block_in(b)
+        if facts is universe:
+            continue
+        for i in blocks[b]:
+            facts = transfer(instrs[i], facts, aa)
+        if facts != out[b]:
+            out[b] = facts
+            for succ in range(len(blocks)):
+                if b in preds[succ] and succ not in worklist:
+                    worklist.append(succ)
+    new_instrs = []
+    for b, block in enumerate(blocks):
+        facts = block_in(b)
+        if facts is universe: # unreachable
+            facts = set()
+        for i in block:
+            facts = transfer(instrs[i], facts, aa, new_instrs)
+    func["instrs"] = new_instrs
+
+
+def eliminate_stores(func, aa):
+    instrs = func["instrs"]
+    blocks, _ = split_blocks(instrs)
+    dead = set()
+    for block in blocks:
+        overwritten = set() # pointers stored later in the block
+        for i in reversed(block):
+            instr = instrs[i]
+            op = instr.get("op")
+            args = instr.get("args", [])
+            if "dest" in instr:
+                overwritten.discard(instr["dest"])
+            if op == "store":
+                if args[0] in overwritten:
+                    dead.add(i)
+                overwritten.add(args[0])
+            elif op == "load":
+                overwritten = {ptr for ptr in overwritten if not aa.may_alias(ptr, args[0])}
+            elif op is not None and op not in SIDE_EFFECT_FREE:
+                overwritten = set()
+    func["instrs"] = [instr for i, instr in enumerate(instrs) if i not in dead]
+
+
+def memopt(prg):
+    """Redundant load and dead store elimination
+    """
+    for func in prg["functions"]:
+        aa = AliasAnalysis(func)
+        forward_loads(func, aa)
+        eliminate_stores(func, aa)
+    return prg
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r") as infile:
+            program = json.load(infile)
+    else:
+        program = json.loads(''.join(sys.stdin.readlines())) # already in json format
+    new_program = memopt(program)
+    print(json.dumps(new_program, indent=2))
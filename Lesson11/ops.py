@@ -0,0 +1,334 @@
+"""Opcode handlers of the BVM interpreter
+
+A handler takes (vm, frame, instr, pc), where pc already points to the
+next instruction, and returns the pc to continue from, or -1 after a call
+or a return switched the running frame (vm.frame). The interpreter
+dispatches through the HANDLERS table indexed by opcode, so extensions
+only need to register their own handlers.
+"""
+
+from bytecode import *
+from heap import Pointer
+
+
+def unknown(vm, frame, instr, pc):
+    raise RuntimeError("Unknown instruction: {}".format(frame.func.source[pc - 1]["op"]))
+
+HANDLERS = [unknown] * NUM_OPCODES
+
+
+def register(*ops):
+    """Decorator registering a handler for the given opcodes
+    """
+    def wrapper(handler):
+        for op in ops:
+            HANDLERS[op] = handler
+        return handler
+    return wrapper
+
+
+@register(CONST)
+def const(vm, frame, instr, pc):
+    frame.data[instr[1]] = instr[2]
+    return pc
+
+@register(ID)
+def id_(vm, frame, instr, pc):
+    data = frame.data
+    if instr[3]: # pointer
+        vm.set_pointer(data, instr[1], data[instr[2]])
+    else:
+        data[instr[1]] = data[instr[2]]
+    return pc
+
+@register(NOP)
+def nop(vm, frame, instr, pc):
+    return pc
+
+@register(PRINT)
+def print_(vm, frame, instr, pc):
+    print(frame.data[instr[1]], file=vm.out)
+    return pc
+
+# arithmetic
+@register(ADD)
+def add(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = data[instr[2]] + data[instr[3]]
+    return pc
+
+@register(SUB)
+def sub(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = data[instr[2]] - data[instr[3]]
+    return pc
+
+@register(MUL)
+def mul(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = data[instr[2]] * data[instr[3]]
+    return pc
+
+@register(DIV)
+def div(vm, frame, instr, pc):
+    data = frame.data
+    a, b = data[instr[2]], data[instr[3]]
+    data[instr[1]] = a // b if (a >= 0) == (b > 0) else -(-a // b) # truncated
+    return pc
+
+@register(AND)
+def and_(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = data[instr[2]] & data[instr[3]]
+    return pc
+
+@register(OR)
+def or_(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = data[instr[2]] | data[instr[3]]
+    return pc
+
+@register(NEG)
+def neg(vm, frame, instr, pc):
+    frame.data[instr[1]] = -frame.data[instr[2]]
+    return pc
+
+@register(NOT)
+def not_(vm, frame, instr, pc):
+    frame.data[instr[1]] = not frame.data[instr[2]]
+    return pc
+
+# comparison
+@register(LT)
+def lt(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = data[instr[2]] < data[instr[3]]
+    return pc
+
+@register(GT)
+def gt(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = data[instr[2]] > data[instr[3]]
+    return pc
+
+@register(EQ)
+def eq(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = data[instr[2]] == data[instr[3]]
+    return pc
+
+@register(NE)
+def ne(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = data[instr[2]] != data[instr[3]]
+    return pc
+
+@register(LE)
+def le(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = data[instr[2]] <= data[instr[3]]
+    return pc
+
+@register(GE)
+def ge(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = data[instr[2]] >= data[instr[3]]
+    return pc
+
+# control flow
+@register(JMP)
+def jmp(vm, frame, instr, pc):
+    return instr[1]
+
+@register(BR)
+def br(vm, frame, instr, pc):
+    if frame.data[instr[1]]: # true
+        return instr[2]
+    return instr[3] # false
+
+def leave(vm, value, pointer=False):
+    """Pop the running frame and resume its caller at the saved pc
+
+    pointer: value is a pointer, whose reference moves to the caller
+    """
+    stack = vm.stack
+    if stack:
+        caller = stack.pop()
+        if caller.dest >= 0:
+            old = caller.data[caller.dest]
+            caller.data[caller.dest] = value
+            if pointer and old is not None:
+                vm.release(old.alloc)
+        elif pointer and value is not None: # the result is dropped
+            vm.release(value.alloc)
+        vm.frame = caller
+    else:
+        vm.frame = None
+        vm.retval = value
+
+@register(CALL)
+def call(vm, frame, instr, pc):
+    stack = vm.stack
+    if len(stack) >= vm.max_depth:
+        raise RuntimeError("Stack overflow: more than {} frames".format(vm.max_depth))
+    data = frame.data
+    # suspend the caller with its return address and result slot
+    frame.pc = pc
+    frame.dest = instr[1]
+    stack.append(frame)
+    callee = vm.frame = Frame(vm.funcs[instr[2]], [data[arg] for arg in instr[3]])
+    if callee.func.pointer_args:
+        vm.retain_slots(callee.data, callee.func.pointer_args)
+    return -1
+
+@register(RET)
+def ret(vm, frame, instr, pc):
+    value = frame.data[instr[1]] if instr[1] >= 0 else None
+    if frame.func.pointers:
+        vm.release_frame(frame, value if instr[2] else None)
+        leave(vm, value, instr[2])
+        return -1
+    stack = vm.stack
+    if stack: # same as leave(), inlined as returns are hot
+        caller = stack.pop()
+        if caller.dest >= 0:
+            caller.data[caller.dest] = value
+        vm.frame = caller
+    else:
+        vm.frame = None
+        vm.retval = value
+    return -1
+
+@register(END)
+def end(vm, frame, instr, pc):
+    vm.instr_count -= 1 # implicit return is not an instruction
+    if frame.func.pointers:
+        vm.release_frame(frame)
+    leave(vm, None)
+    return -1
+
+# memory extension
+@register(ALLOC)
+def alloc(vm, frame, instr, pc): # return a pointer
+    data = frame.data
+    vm.set_pointer(data, instr[1], vm.alloc(instr[3], data[instr[2]], instr[4]))
+    return pc
+
+@register(FREE)
+def free(vm, frame, instr, pc):
+    vm.free(frame.data[instr[1]])
+    return pc
+
+@register(PTRADD)
+def ptradd(vm, frame, instr, pc):
+    data = frame.data
+    base = data[instr[2]]
+    vm.set_pointer(data, instr[1], Pointer(base.alloc, base.addr + data[instr[3]]))
+    return pc
+
+@register(LOAD)
+def load(vm, frame, instr, pc):
+    data = frame.data
+    value = vm.cells[instr[3]][data[instr[2]].addr]
+    if instr[3] == POINTER_HEAP:
+        vm.set_pointer(data, instr[1], value)
+    else:
+        data[instr[1]] = value
+    return pc
+
+@register(STORE)
+def store(vm, frame, instr, pc):
+    data = frame.data
+    if instr[4] and vm.speculations: # undone if the speculation fails
+        vm.journal_cell(instr[3], data[instr[1]].addr)
+    if instr[3] == POINTER_HEAP: # the cell references the allocation
+        vm.set_pointer(vm.cells[POINTER_HEAP], data[instr[1]].addr, data[instr[2]])
+    else:
+        try:
+            vm.cells[instr[3]][data[instr[1]].addr] = data[instr[2]]
+        except (OverflowError, TypeError):
+            store_wide(vm, instr[3], data[instr[1]].addr, data[instr[2]])
+    return pc
+
+def store_wide(vm, kind, addr, value):
+    """Store a value that the typed cells of a heap cannot hold, like an
+    int beyond 64 bits, once the heap keeps its cells in a list
+    """
+    heap = vm.heaps[kind]
+    heap.widen()
+    vm.cells[kind] = heap.cells
+    heap.cells[addr] = value
+
+# floating-point extension
+register(FADD)(add)
+register(FSUB)(sub)
+register(FMUL)(mul)
+
+@register(FDIV)
+def fdiv(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = data[instr[2]] / data[instr[3]]
+    return pc
+
+register(FEQ)(eq)
+register(FLT)(lt)
+register(FGT)(gt)
+register(FLE)(le)
+register(FGE)(ge)
+
+# superinstructions, which count their second instruction themselves
+@register(CMP_BR)
+def cmp_br(vm, frame, instr, pc):
+    data = frame.data
+    cond = data[instr[2]] = instr[1](data[instr[3]], data[instr[4]])
+    vm.instr_count += 1
+    if cond: # true
+        return instr[5]
+    return instr[6] # false
+
+@register(BINARY_JMP)
+def binary_jmp(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[2]] = instr[1](data[instr[3]], data[instr[4]])
+    vm.instr_count += 1
+    return instr[5]
+
+@register(CONST_BINARY)
+def const_binary(vm, frame, instr, pc):
+    data = frame.data
+    data[instr[1]] = instr[2]
+    data[instr[4]] = instr[3](data[instr[5]], data[instr[6]])
+    vm.instr_count += 1
+    return pc + 1
+
+@register(PTRADD_LOAD)
+def ptradd_load(vm, frame, instr, pc):
+    data = frame.data
+    base = data[instr[2]]
+    ptr = Pointer(base.alloc, base.addr + data[instr[3]])
+    vm.set_pointer(data, instr[1], ptr)
+    value = vm.cells[instr[5]][ptr.addr]
+    if instr[5] == POINTER_HEAP:
+        vm.set_pointer(data, instr[4], value)
+    else:
+        data[instr[4]] = value
+    vm.instr_count += 1
+    return pc + 1
+
+@register(PTRADD_STORE)
+def ptradd_store(vm, frame, instr, pc):
+    data = frame.data
+    base = data[instr[2]]
+    ptr = Pointer(base.alloc, base.addr + data[instr[3]])
+    vm.set_pointer(data, instr[1], ptr)
+    if instr[6] and vm.speculations:
+        vm.journal_cell(instr[5], ptr.addr)
+    if instr[5] == POINTER_HEAP:
+        vm.set_pointer(vm.cells[POINTER_HEAP], ptr.addr, data[instr[4]])
+    else:
+        try:
+            vm.cells[instr[5]][ptr.addr] = data[instr[4]]
+        except (OverflowError, TypeError):
+            store_wide(vm, instr[5], ptr.addr, data[instr[4]])
+    vm.instr_count += 1
+    return pc + 1
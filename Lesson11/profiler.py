@@ -0,0 +1,147 @@
+"""Execution profiler of the BVM
+
+    python3 bvm.py --profile profile.json -f test/bubblesort.json 5 10 7 5 1 3
+
+The profiler runs the program with its own copy of the interpreter loop,
+which counts every opcode, basic block, control-flow edge and branch
+direction, and times every function. The engines of the VM are left
+untouched, so profiling costs nothing when it is off. The profile is a
+JSON file of the form
+
+    {"instr_count": 260,
+     "opcodes": {"add": 20, ...},
+     "functions": {"main": {
+         "calls": 1,
+         "inclusive": 0.0012, "exclusive": 0.0003, # seconds
+         "blocks": [{"pc": 4, "label": "loop", "count": 6}, ...],
+         "edges": [{"from": 4, "to": 7, "count": 5}, ...],
+         "branches": [{"pc": 6, "labels": ["body", "done"], "taken": 5, "not_taken": 1}, ...]}}}
+
+where a pc is the index of an instruction in the function, labels excluded.
+"""
+
+import json
+import time
+from bytecode import *
+from pyjit import find_leaders
+
+OPCODE_NAMES = {op: name for name, op in OPCODES.items()}
+
+
+class FunctionProfile(object):
+
+    def __init__(self, func) -> None:
+        self.func = func
+        self.calls = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+        self.active = 0 # activations on the stack, for recursive functions
+        leaders = find_leaders(func)
+        self.is_leader = [False] * len(func.instrs)
+        self.block = [0] * len(func.instrs) # leader of the block of each pc
+        for i, start in enumerate(leaders):
+            self.is_leader[start] = True
+            end = leaders[i + 1] if i + 1 < len(leaders) else len(func.instrs)
+            for pc in range(start, end):
+                self.block[pc] = start
+        self.blocks = {start: 0 for start in leaders}
+        self.edges = {} # (from, to)->count
+        self.branches = {} # pc->[taken, not taken]
+
+    def dump(self):
+        labels = {pc: label for label, pc in self.func.labels.items()}
+        res = {"calls": self.calls, "inclusive": self.inclusive, "exclusive": self.exclusive}
+        res["blocks"] = [{"pc": pc, "label": labels.get(pc), "count": count}
+                         for pc, count in sorted(self.blocks.items())]
+        res["edges"] = [{"from": src, "to": dst, "count": count}
+                        for (src, dst), count in sorted(self.edges.items())]
+        res["branches"] = [{"pc": pc, "labels": self.func.source[pc]["labels"], "taken": taken, "not_taken": not_taken}
+                           for pc, (taken, not_taken) in sorted(self.branches.items())]
+        return res
+
+
+class Profiler(object):
+
+    def __init__(self, vm) -> None:
+        self.vm = vm
+        self.opcodes = [0] * NUM_OPCODES
+        self.funcs = {} # name->FunctionProfile
+
+    def profile(self, func):
+        prof = self.funcs.get(func.name)
+        if prof is None:
+            prof = self.funcs[func.name] = FunctionProfile(func)
+        return prof
+
+    def eval(self, input_args):
+        """Run main like VirtualMachine.eval, but with the profiling loop
+        """
+        self.eval_frame(self.vm.main_frame(input_args))
+        self.vm.report()
+
+    def eval_frame(self, frame):
+        """Instrumented copy of VirtualMachine.eval_frame
+        """
+        vm = self.vm
+        vm.frame = frame
+        handlers = vm.handlers # with the memoized calls of --memoize
+        opcodes = self.opcodes
+        count = 0
+        # (profile, start time, time spent in callees) of every activation
+        calls = []
+        self.enter(frame, calls)
+        while frame is not None:
+            prof = calls[-1][0]
+            instrs = frame.func.instrs # without superinstructions
+            pc = frame.pc
+            # a resumed caller comes from the block of its call
+            prev = prof.block[pc - 1] if pc > 0 else -1
+            while pc >= 0:
+                if prof.is_leader[pc]:
+                    prof.blocks[pc] += 1
+                    if prev >= 0:
+                        edge = (prev, pc)
+                        prof.edges[edge] = prof.edges.get(edge, 0) + 1
+                    prev = pc
+                instr = instrs[pc]
+                op = instr[0]
+                opcodes[op] += 1
+                count += 1
+                next_pc = handlers[op](vm, frame, instr, pc + 1)
+                if op == BR:
+                    counts = prof.branches.setdefault(pc, [0, 0])
+                    counts[0 if next_pc == instr[2] else 1] += 1
+                pc = next_pc
+            depth = len(calls)
+            if vm.frame is not None and len(vm.stack) >= depth:
+                self.enter(vm.frame, calls) # called
+            else:
+                self.leave(calls) # returned
+            frame = vm.frame
+        vm.instr_count += count
+        return vm.retval
+
+    def enter(self, frame, calls):
+        prof = self.profile(frame.func)
+        prof.calls += 1
+        prof.active += 1
+        calls.append([prof, time.perf_counter(), 0.0])
+
+    def leave(self, calls):
+        prof, start, callees = calls.pop()
+        elapsed = time.perf_counter() - start
+        prof.exclusive += elapsed - callees
+        prof.active -= 1
+        if prof.active == 0: # recursive activations are already included
+            prof.inclusive += elapsed
+        if calls:
+            calls[-1][2] += elapsed
+
+    def dump(self, filename):
+        res = {"instr_count": self.vm.instr_count}
+        # the implicit return at the end is not an instruction
+        res["opcodes"] = {OPCODE_NAMES[op]: count for op, count in enumerate(self.opcodes)
+                          if count > 0 and op in OPCODE_NAMES}
+        res["functions"] = {name: prof.dump() for name, prof in self.funcs.items()}
+        with open(filename, "w") as outfile:
+            outfile.write(json.dumps(res, indent=2))
@@ -0,0 +1,179 @@
+"""Compile decoded Bril functions into Python code, one function per block.
+
+A basic block becomes a straight-line Python function that works directly
+on the register list of a frame and returns the pc of the next block (or
+-1 after a call or a return switched the running frame). The VM only has to run a small loop
+that jumps between the compiled blocks. Instructions without a code
+template call their interpreter handler.
+"""
+
+from bytecode import *
+from heap import Pointer
+from ops import store_wide
+
+# int div is a call of int_div
+BINARY_SYMBOLS = {
+    ADD: "+", SUB: "-", MUL: "*", AND: "&", OR: "|",
+    LT: "<", GT: ">", EQ: "==", NE: "!=", LE: "<=", GE: ">=",
+    FADD: "+", FSUB: "-", FMUL: "*", FDIV: "/",
+    FEQ: "==", FLT: "<", FGT: ">", FLE: "<=", FGE: ">=",
+}
+
+TERMINATORS = (JMP, BR, RET, END, CALL)
+
+
+def find_leaders(func):
+    """Return the sorted pcs that start a basic block
+    """
+    leaders = {0}
+    for pc, instr in enumerate(func.instrs):
+        op = instr[0]
+        if op == JMP:
+            leaders.add(instr[1])
+        elif op == BR:
+            leaders.update((instr[2], instr[3]))
+        elif op == GUARD:
+            leaders.add(instr[2])
+        if op in TERMINATORS and pc + 1 < len(func.instrs):
+            leaders.add(pc + 1)
+    leaders.update(func.labels.values())
+    return sorted(pc for pc in leaders if pc < len(func.instrs))
+
+
+class Compiler(object):
+    """Generate the Python source of every block of a function
+
+    handlers: interpreter handlers of the instructions without a template
+    """
+
+    def __init__(self, func, handlers) -> None:
+        self.func = func
+        self.handlers = handlers
+        self.consts = []
+
+    def const(self, value):
+        if type(value) in (int, bool):
+            return repr(value)
+        self.consts.append(value)
+        return "K[{}]".format(len(self.consts) - 1)
+
+    def exit(self, lines, indent, executed, target):
+        lines.append("{}vm.instr_count += {}".format(indent, executed))
+        lines.append("{}return {}".format(indent, target))
+
+    def compile_block(self, start, end):
+        func = self.func
+        lines = ["def block_{}(vm, frame, r):".format(start)]
+        ind = "    "
+        for pc in range(start, end):
+            instr = func.instrs[pc]
+            op = instr[0]
+            executed = pc - start + 1
+            if op == CONST:
+                lines.append("{}r[{}] = {}".format(ind, instr[1], self.const(instr[2])))
+            elif op == ID and instr[3]:
+                lines.append("{}vm.set_pointer(r, {}, r[{}])".format(ind, instr[1], instr[2]))
+            elif op == ID:
+                lines.append("{}r[{}] = r[{}]".format(ind, instr[1], instr[2]))
+            elif op in BINARY_SYMBOLS:
+                lines.append("{}r[{}] = r[{}] {} r[{}]".format(ind, instr[1], instr[2], BINARY_SYMBOLS[op], instr[3]))
+            elif op == DIV:
+                lines.append("{}r[{}] = int_div(r[{}], r[{}])".format(ind, instr[1], instr[2], instr[3]))
+            elif op == NEG:
+                lines.append("{}r[{}] = -r[{}]".format(ind, instr[1], instr[2]))
+            elif op == NOT:
+                lines.append("{}r[{}] = not r[{}]".format(ind, instr[1], instr[2]))
+            elif op == PTRADD:
+                # moving within the same allocation changes no reference count
+                lines.append("{}base = r[{}]".format(ind, instr[2]))
+                lines.append("{}ptr = Pointer(base.alloc, base.addr + r[{}])".format(ind, instr[3]))
+                lines.append("{}if r[{}] is not None and r[{}].alloc is base.alloc:".format(ind, instr[1], instr[1]))
+                lines.append("{}    r[{}] = ptr".format(ind, instr[1]))
+                lines.append("{}else:".format(ind))
+                lines.append("{}    vm.set_pointer(r, {}, ptr)".format(ind, instr[1]))
+            elif op == LOAD and instr[3] == POINTER_HEAP:
+                lines.append("{}vm.set_pointer(r, {}, vm.cells[{}][r[{}].addr])".format(ind, instr[1], instr[3], instr[2]))
+            elif op == LOAD:
+                lines.append("{}r[{}] = vm.cells[{}][r[{}].addr]".format(ind, instr[1], instr[3], instr[2]))
+            elif op == STORE and instr[4]:
+                # journaled by the handler when speculating
+                lines.append("{}H[{}](vm, frame, I[{}], {})".format(ind, op, pc, pc + 1))
+            elif op == STORE and instr[3] == POINTER_HEAP:
+                lines.append("{}vm.set_pointer(vm.cells[{}], r[{}].addr, r[{}])".format(ind, instr[3], instr[1], instr[2]))
+            elif op == STORE:
+                lines.append("{}try:".format(ind))
+                lines.append("{}    vm.cells[{}][r[{}].addr] = r[{}]".format(ind, instr[3], instr[1], instr[2]))
+                lines.append("{}except (OverflowError, TypeError):".format(ind))
+                lines.append("{}    store_wide(vm, {}, r[{}].addr, r[{}])".format(ind, instr[3], instr[1], instr[2]))
+            elif op == ALLOC:
+                lines.append("{}vm.set_pointer(r, {}, vm.alloc({!r}, r[{}], {}))".format(
+                    ind, instr[1], instr[3], instr[2], instr[4]))
+            elif op == FREE:
+                lines.append("{}vm.free(r[{}])".format(ind, instr[1]))
+            elif op == PRINT:
+                lines.append("{}print(r[{}], file=vm.out)".format(ind, instr[1]))
+            elif op == NOP:
+                pass
+            elif op == JMP:
+                self.exit(lines, ind, executed, instr[1])
+                break
+            elif op == BR:
+                self.exit(lines, ind, executed, "{} if r[{}] else {}".format(instr[2], instr[1], instr[3]))
+                break
+            elif op == CALL:
+                # suspend the caller, it resumes at the block after the call
+                args = "".join("r[{}], ".format(arg) for arg in instr[3])
+                lines.append("{}if len(vm.stack) >= vm.max_depth:".format(ind))
+                lines.append("{}    H[{}](vm, frame, I[{}], {}) # raise the overflow".format(ind, op, pc, pc + 1))
+                lines.append("{}frame.pc = {}".format(ind, pc + 1))
+                lines.append("{}frame.dest = {}".format(ind, instr[1]))
+                lines.append("{}vm.stack.append(frame)".format(ind))
+                lines.append("{}callee = vm.frame = Frame(vm.funcs[{!r}], [{}])".format(ind, instr[2], args))
+                lines.append("{}if callee.func.pointer_args:".format(ind))
+                lines.append("{}    vm.retain_slots(callee.data, callee.func.pointer_args)".format(ind))
+                self.exit(lines, ind, executed, -1)
+                break
+            elif op == RET and not func.pointers:
+                # nothing to release, resume the caller directly
+                value = "r[{}]".format(instr[1]) if instr[1] >= 0 else "None"
+                lines.append("{}vm.instr_count += {}".format(ind, executed))
+                lines.append("{}stack = vm.stack".format(ind))
+                lines.append("{}if stack:".format(ind))
+                lines.append("{}    caller = stack.pop()".format(ind))
+                lines.append("{}    if caller.dest >= 0:".format(ind))
+                lines.append("{}        caller.data[caller.dest] = {}".format(ind, value))
+                lines.append("{}    vm.frame = caller".format(ind))
+                lines.append("{}else:".format(ind))
+                lines.append("{}    vm.frame = None".format(ind))
+                lines.append("{}    vm.retval = {}".format(ind, value))
+                lines.append("{}return -1".format(ind))
+                break
+            elif op in TERMINATORS:
+                # returns switch frames through their handlers
+                lines.append("{}pc = H[{}](vm, frame, I[{}], {})".format(ind, op, pc, pc + 1))
+                self.exit(lines, ind, executed, "pc")
+                break
+            else:
+                # the handler may leave the block, e.g., a failing guard
+                lines.append("{}pc = H[{}](vm, frame, I[{}], {})".format(ind, op, pc, pc + 1))
+                lines.append("{}if pc != {}:".format(ind, pc + 1))
+                self.exit(lines, ind + "    ", executed, "pc")
+        else:
+            # fall through to the next block
+            self.exit(lines, ind, end - start, end)
+        return "\n".join(lines)
+
+    def compile(self):
+        """Return a list indexed by pc, holding the compiled block that
+        starts at that pc, or None
+        """
+        leaders = find_leaders(self.func)
+        bounds = leaders + [len(self.func.instrs)]
+        source = "\n\n".join(self.compile_block(bounds[i], bounds[i + 1]) for i in range(len(leaders)))
+        env = {"K": self.consts, "H": self.handlers, "I": self.func.instrs, "Frame": Frame, "Pointer": Pointer,
+               "int_div": int_div, "store_wide": store_wide}
+        exec(compile(source, "<pyjit {}>".format(self.func.name), "exec"), env)
+        blocks = [None] * len(self.func.instrs)
+        for pc in leaders:
+            blocks[pc] = env["block_{}".format(pc)]
+        return blocks
@@ -0,0 +1,108 @@
+"""Run many BVM jobs on a pool of processes
+
+    python3 runner.py jobs.txt [-j 8] [--engine pyjit] [--json] [--vm ../Lesson12/bvm.py]
+
+Every line of the jobs file is a program followed by its arguments, e.g.,
+`test/fib.json`. The output, the dynamic instruction count and the
+wall time of every job are reported in the order of the file. A worker
+loads a program once and reuses it for all its jobs on that program. The
+jobs run on the VirtualMachine of the bvm.py next to this file, or of the
+one given by --vm, like the tracing VM of Lesson 12.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import multiprocessing
+from brilc import load_program
+
+DEFAULT_VM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bvm.py")
+
+VirtualMachine = None # of the bvm.py running the jobs, per worker
+VMS = {} # (path, engine)->VM with the loaded program, per worker
+
+
+def use_vm(path):
+    """Import the VirtualMachine of the bvm.py at path
+    """
+    global VirtualMachine
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    VirtualMachine = importlib.import_module(os.path.splitext(os.path.basename(path))[0]).VirtualMachine
+
+
+def load(path, engine):
+    if (path, engine) not in VMS:
+        program, funcs = load_program(path)
+        VMS[(path, engine)] = VirtualMachine(program, engine, funcs=funcs)
+    return VMS[(path, engine)]
+
+
+def run_job(job):
+    """Run a (program path, arguments, engine) job and return its result
+    """
+    path, args, engine = job
+    out = io.StringIO()
+    res = {"program": path, "args": args, "instr_count": None, "time": None, "error": None}
+    try:
+        vm = load(path, engine)
+        start = time.perf_counter()
+        try:
+            vm.run(args, out)
+        finally:
+            res["time"] = time.perf_counter() - start
+            res["instr_count"] = vm.instr_count
+    except Exception as err:
+        res["error"] = "{}: {}".format(type(err).__name__, err)
+    res["output"] = out.getvalue()
+    return res
+
+
+def run_jobs(jobs, processes=None, vm=DEFAULT_VM):
+    """Run the jobs on a pool of processes, with the VM of the bvm.py at
+    vm, and return their results in order
+    """
+    if len(jobs) == 0:
+        return []
+    processes = processes or multiprocessing.cpu_count()
+    # large chunks keep the jobs on the same program in the same worker
+    chunksize = max(1, len(jobs) // (4 * processes))
+    with multiprocessing.Pool(processes, use_vm, (vm,)) as pool:
+        return pool.map(run_job, jobs, chunksize)
+
+
+def read_jobs(filename, engine):
+    jobs = []
+    with open(filename, "r") as infile:
+        for line in infile:
+            words = line.split()
+            if len(words) > 0 and not words[0].startswith("#"):
+                jobs.append((words[0], words[1:], engine))
+    return jobs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run BVM jobs in parallel')
+    parser.add_argument('jobs', help='file with one program and its arguments per line')
+    parser.add_argument('-j', dest='processes', type=int, default=None, help='number of processes (default: all cores)')
+    parser.add_argument('--engine', default="interp", choices=["interp", "pyjit", "tracejit"], help='execution engine (tracejit needs the VM of Lesson 12)')
+    parser.add_argument('--vm', default=DEFAULT_VM, help='bvm.py to run the jobs with')
+    parser.add_argument('--json', action='store_true', help='report the results in JSON')
+    args = parser.parse_args()
+
+    jobs = read_jobs(args.jobs, args.engine)
+    start = time.perf_counter()
+    results = run_jobs(jobs, args.processes, args.vm)
+    elapsed = time.perf_counter() - start
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for res in results:
+            print("== {} {}: {} instrs, {:.6f}s".format(res["program"], " ".join(res["args"]), res["instr_count"], res["time"] or 0))
+            print(res["output"], end="")
+            if res["error"] is not None:
+                print(res["error"])
+        print("== {} jobs in {:.3f}s".format(len(results), elapsed), file=sys.stderr)
@@ -0,0 +1,214 @@
+"""Escape analysis and scalar replacement of allocations
+
+    python3 sroa.py test/mem.json | python3 bvm.py
+
+An alloc of a constant number of int, float or bool cells is replaced by
+one variable per cell when its pointer does not escape the function: the
+pointer and the pointers derived from it by ptradd and id are only used
+to load, store and free, with constant offsets that stay in the block,
+and are never returned, passed to a call, stored or printed. Each of
+these pointers must have a single definition, so that its offset is
+known everywhere. The loads and stores become ids of the cell variables,
+which start at zero like the cells of the VM, and the alloc, its free
+and the pointer arithmetic disappear, together with their heap traffic
+and reference counting.
+
+An alloc in a loop gets a new block at every iteration, so it is only
+replaced when all the uses of its pointers follow it in its basic block.
+"""
+
+import sys
+import json
+
+TERMINATORS = ["jmp", "br", "ret"]
+ZEROS = {"int": 0, "float": 0.0, "bool": False}
+
+
+def form_blocks(instrs):
+    """Return the index of the block of every instruction and the
+    successors of every block
+    """
+    block_of = []
+    labels = {}
+    block, empty = 0, True
+    for instr in instrs:
+        if "label" in instr:
+            if not empty: # falls through to the label
+                block, empty = block + 1, True
+            labels[instr["label"]] = block
+        block_of.append(block)
+        empty = False
+        if instr.get("op") in TERMINATORS:
+            block, empty = block + 1, True
+    succs = {}
+    for i, instr in enumerate(instrs):
+        b = block_of[i]
+        if i + 1 < len(instrs) and block_of[i + 1] == b:
+            continue
+        if instr.get("op") in ["jmp", "br"]:
+            succs[b] = [labels[label] for label in instr["labels"]]
+        elif instr.get("op") == "ret":
+            succs[b] = []
+        else:
+            succs[b] = [b + 1]
+    return block_of, succs
+
+
+def in_cycle(succs, block):
+    """Return whether block can be reached again from itself
+    """
+    seen = set()
+    todo = list(succs.get(block, []))
+    while todo:
+        b = todo.pop()
+        if b == block:
+            return True
+        if b not in seen:
+            seen.add(b)
+            todo += succs.get(b, [])
+    return False
+
+
+def constants(func, defs):
+    """Return the int variables defined once, by a const
+    """
+    consts = {}
+    for instr in func["instrs"]:
+        if instr.get("op") == "const" and instr.get("type") == "int" and len(defs[instr["dest"]]) == 1:
+            consts[instr["dest"]] = instr["value"]
+    return consts
+
+
+def find_family(instrs, base, defs, consts):
+    """Return the offset of every pointer derived from base, or None if one
+    of them has no single, constant offset
+    """
+    family = {base: 0}
+    changed = True
+    while changed:
+        changed = False
+        for instr in instrs:
+            if instr.get("op") not in ["ptradd", "id"] or instr["args"][0] not in family:
+                continue
+            dest = instr["dest"]
+            if instr["op"] == "id":
+                offset = family[instr["args"][0]]
+            elif instr["args"][1] in consts:
+                offset = family[instr["args"][0]] + consts[instr["args"][1]]
+            else:
+                return None # unknown offset
+            if len(defs[dest]) != 1 or family.get(dest, offset) != offset:
+                return None
+            if dest not in family:
+                family[dest] = offset
+                changed = True
+    return family
+
+
+def escapes(instrs, family, size):
+    """Return whether a pointer of the family is used other than to load,
+    store, free or derive another pointer of the family
+    """
+    for instr in instrs:
+        args = instr.get("args", [])
+        if not any(arg in family for arg in args):
+            continue
+        op = instr["op"]
+        if op in ["ptradd", "id"] and instr["dest"] in family:
+            if args[-1] in family and op == "ptradd":
+                return True
+        elif op == "load":
+            if not 0 <= family[args[0]] < size:
+                return True
+        elif op == "store":
+            if args[1] in family or not 0 <= family[args[0]] < size:
+                return True
+        elif op == "free":
+            if family[args[0]] != 0:
+                return True
+        else: # returned, passed, printed...
+            return True
+    return False
+
+
+def uses_follow(instrs, block_of, start, family):
+    """Return whether every instruction using or defining a pointer of the
+    family is after start in its block
+    """
+    for i, instr in enumerate(instrs):
+        if any(arg in family for arg in instr.get("args", [])) or instr.get("dest") in family:
+            if i != start and (block_of[i] != block_of[start] or i < start):
+                return False
+    return True
+
+
+def fresh_name(names, base, offset):
+    name = "{}.{}".format(base, offset)
+    while name in names:
+        name += "_"
+    names.add(name)
+    return name
+
+
+def sroa_function(func):
+    instrs = func["instrs"]
+    defs = {}
+    for arg in func.get("args", []):
+        defs.setdefault(arg["name"], []).append(None)
+    for i, instr in enumerate(instrs):
+        if "dest" in instr:
+            defs.setdefault(instr["dest"], []).append(i)
+    consts = constants(func, defs)
+    block_of, succs = form_blocks(instrs)
+    names = set(defs)
+    replaced = {} # index of an instruction->its replacements
+    for i, instr in enumerate(instrs):
+        if instr.get("op") != "alloc" or instr["args"][0] not in consts:
+            continue
+        base, size = instr["dest"], consts[instr["args"][0]]
+        pointee = instr["type"]["ptr"]
+        if not isinstance(pointee, str) or pointee not in ZEROS or len(defs[base]) != 1 or size < 1:
+            continue
+        family = find_family(instrs, base, defs, consts)
+        if family is None or escapes(instrs, family, size):
+            continue
+        if in_cycle(succs, block_of[i]) and not uses_follow(instrs, block_of, i, family):
+            continue
+        cells = {}
+        for j, use in enumerate(instrs):
+            args = use.get("args", [])
+            if use.get("op") in ["load", "store"] and args[0] in family:
+                offset = family[args[0]]
+                if offset not in cells:
+                    cells[offset] = fresh_name(names, base, offset)
+                if use["op"] == "load":
+                    replaced[j] = [{"op": "id", "dest": use["dest"], "type": use["type"], "args": [cells[offset]]}]
+                else:
+                    replaced[j] = [{"op": "id", "dest": cells[offset], "type": pointee, "args": [args[1]]}]
+            elif use.get("op") == "free" and args[0] in family:
+                replaced[j] = []
+            elif use.get("dest") in family and j != i:
+                replaced[j] = [] # ptradd or id
+        replaced[i] = [{"op": "const", "dest": cells[offset], "type": pointee, "value": ZEROS[pointee]}
+                       for offset in sorted(cells)]
+    new_instrs = []
+    for i, instr in enumerate(instrs):
+        new_instrs += replaced.get(i, [instr])
+    func["instrs"] = new_instrs
+
+
+def sroa(prg):
+    """Scalar replacement of the allocations that do not escape
+    """
+    for func in prg["functions"]:
+        sroa_function(func)
+    return prg
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r") as infile:
+            program = json.load(infile)
+    else:
+        program = json.loads(''.join(sys.stdin.readlines())) # already in json format
+    new_program = sroa(program)
+    print(json.dumps(new_program, indent=2))
@@ -1,89 +1,195 @@
+import io
+import os
 import sys
 import json
 import argparse
+# the VM modules of Lesson 11, extended here with speculation and tracing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Lesson11"))
+from bytecode import *
+from pyjit import Compiler
+from tracejit import Trace, TraceCompiler, MAX_TREE_DEPTH
+from profiler import Profiler
+from memo import Memoizer
+from heap import Heap, Allocation, Pointer, POLICIES, HEAP_NAMES
+from census import Census
+from brilc import load_program
+from ops import HANDLERS, register
 
-MEMORY_SIZE = 4096
+MEMORY_SIZE = 4096 # initial cells of every heap, which grow on demand
+MAX_STACK_DEPTH = 100000
+HOT_LOOP = 5 # back edges to a loop header before tracing the loop
+MAX_TRACE_LENGTH = 1000 # executed instructions before giving up a trace
 
-class Frame(object):
 
-    def __init__(self, name, instrs, initial_data = {}) -> None:
-        """
-        initial_data: maps from variable name to value
-        """
-        self.name = name
-        self.instrs = instrs
-        self.data = initial_data
-        self.blocks = {}
-        for idx, instr in enumerate(self.instrs):
-            if "label" in instr:
-                self.blocks[instr["label"]] = idx
-
-    def eval_const(self, instr) -> None:
-        self.data[instr["dest"]] = instr["value"]
-
-    def eval_unary_op(self, instr) -> None:
-        if instr["op"] == "neg":
-            self.data[instr["dest"]] = -self.data[instr["args"][0]]
-        elif instr["op"] == "not":
-            self.data[instr["dest"]] = ~self.data[instr["args"][0]]
-
-    def eval_binary_op(self, instr) -> None:
-        if instr["op"] == "add":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] + self.data[instr["args"][1]]
-        elif instr["op"] == "sub":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] - self.data[instr["args"][1]]
-        elif instr["op"] == "mul":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] * self.data[instr["args"][1]]
-        elif instr["op"] == "div":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] / self.data[instr["args"][1]]
-        elif instr["op"] == "or":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] | self.data[instr["args"][1]]
-        elif instr["op"] == "and":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] & self.data[instr["args"][1]]
-
-    def eval_compare_op(self, instr) -> None:
-        if instr["op"] == "lt":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] < self.data[instr["args"][1]]
-        elif instr["op"] == "gt":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] > self.data[instr["args"][1]]
-        elif instr["op"] == "eq":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] == self.data[instr["args"][1]]
-        elif instr["op"] == "ne":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] != self.data[instr["args"][1]]
-        elif instr["op"] == "le":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] <= self.data[instr["args"][1]]
-        elif instr["op"] == "ge":
-            self.data[instr["dest"]] = self.data[instr["args"][0]] >= self.data[instr["args"][1]]
+# speculative execution
+class Speculation(object):
+    """A running speculate, which can be undone
+
+    saved: values of the registers the region may write (instr[1])
+    pointers: values of its pointer registers (instr[2]), whose
+              allocations are kept alive until the commit
+    mark: length of the heap journal of the VM when it started
+    logged: (heap, addr) of the cells it journaled, once there are some
+    """
+    __slots__ = ("frame", "instr", "saved", "pointers", "mark", "logged")
+
+    def __init__(self, frame, instr, mark) -> None:
+        data = frame.data
+        self.frame = frame
+        self.instr = instr
+        self.saved = [data[slot] for slot in instr[1]]
+        self.pointers = [data[slot] for slot in instr[2]] if instr[2] else ()
+        self.mark = mark
+        self.logged = None
+
+
+@register(SPECULATE)
+def speculate(vm, frame, instr, pc):
+    spec = Speculation(frame, instr, len(vm.journal))
+    for ptr in spec.pointers:
+        if ptr is not None:
+            ptr.alloc.refs += 1
+    vm.speculations.append(spec)
+    return pc
+
+@register(COMMIT)
+def commit(vm, frame, instr, pc):
+    if vm.speculations: # done successfully
+        spec = vm.speculations.pop()
+        for ptr in spec.pointers:
+            if ptr is not None:
+                vm.release(ptr.alloc)
+        # an outer speculation keeps the journal of the inner one
+        if not vm.speculations and vm.journal:
+            vm.clear_journal()
+    return pc
+
+@register(GUARD)
+def guard(vm, frame, instr, pc):
+    if not frame.data[instr[1]]: # exit from the innermost speculation
+        if not vm.speculations or vm.speculations[-1].frame is not frame:
+            raise RuntimeError("Guard failed outside of a speculation")
+        vm.abort()
+        return instr[2]
+    return pc
 
 
 class VirtualMachine(object):
 
-    def __init__(self, program) -> None:
-        self.funcs = program["functions"]
-        funcs_map = {}
-        for func in self.funcs:
-            funcs_map[func["name"]] = func
+    def __init__(self, program, engine="interp", max_depth=MAX_STACK_DEPTH, funcs=None, out=None, memo_size=0,
+                 alloc_policy="best") -> None:
+        """
+        funcs: functions already decoded from program, e.g., by a previous VM
+        out: file receiving the output of the program (default: stdout)
+        memo_size: number of results of pure functions to cache (0: none)
+        alloc_policy: "first" or "best" fit of the heap allocator
+        """
+        self.main = None
+        for func in program["functions"]:
             if func["name"] == "main":
                 self.main = func
-        self.funcs = funcs_map
+        # functions are decoded on their first call
+        self.funcs = funcs if funcs is not None else decode_program(program)
+        self.stdout = out if out is not None else sys.stdout
+        # execution engine: "interp", "pyjit" or "tracejit"
+        self.engine = engine
+        self.max_depth = max_depth
+        self.alloc_policy = alloc_policy
+        # memoization of the pure functions, in the interpreter only
+        self.memo = None
+        self.census = None # sampled after every allocation when set
+        self.hot_loop = HOT_LOOP
+        self.max_trace_length = MAX_TRACE_LENGTH
+        self.handlers = HANDLERS
+        if memo_size > 0:
+            if engine != "interp":
+                raise RuntimeError("Memoization needs the interp engine")
+            self.memo = Memoizer(program, self.funcs, memo_size)
+            self.handlers = self.memo.handlers
+        self.reset()
+
+    def reset(self):
+        """Start a new run on fresh state
+        """
+        self.out = self.stdout
+        # call stack
+        self.frame = None # running frame
+        self.stack = [] # suspended callers
+        self.retval = None
+        if self.memo is not None:
+            self.memo.keys = [] # the cached results are kept
         # memory facility
-        self.memory = [0] * MEMORY_SIZE
-        self.memory_usage = [False] * MEMORY_SIZE
-        self.memory_ptr = 0
-        self.allocated = {} # var->memory_size
-        # garbage collection
-        self.reference_count = {} # var->ref_count
+        self.heaps = [Heap(MEMORY_SIZE, self.alloc_policy, kind) for kind in range(NUM_HEAPS)]
+        self.cells = [heap.cells for heap in self.heaps] # grown in place
+        # garbage collection, by reference counting of the allocations
+        self.allocations = set() # live allocations
         # speculative execution
-        self.spec_data = {}
-        # JIT tracing
+        self.speculations = [] # running speculations, the innermost last
+        self.journal = [] # (heap, addr, old value) of the cells they wrote
+        self.journal_refs = 0 # pointers held by the journal
+        # JIT tracing of the hot loops
         self.flag_trace = False
+        self.hotness = {} # (function, header pc)->back edges taken to it
+        self.traced = set() # loops already traced, or given up
+        self.traces = [] # finished traces
+        self.trees = {} # (function, header pc)->Trace at the root of the tree of the loop
+        self.following = None # (Trace, path index, frame of the loop) of the iteration running a tree
+        self.recording = None # (frame, header pc) of the loop being traced
+        self.parent_exit = None # (Trace, path index) of the side exit being traced
+        self.trace_name = None # name of the Trace being recorded
+        self.trace_length = 0 # instructions executed while recording
         self.trace = []
+        self.path = [] # (depth, function, pc, taken) of the recorded instructions
+        self.contexts = {} # path index of a branch->(inlined calls, number of calls inlined so far)
+        self.written = [] # (variable, type) of the function of the loop written by the trace
+        self.num_inlined = 0 # calls inlined into the trace
+        self.pure = True # whether the trace can be undone by a failing guard
+        self.compiled = {} # (function, header pc)->compiled trace of the loop
         self.call_ret = []
         self.instr_count = 0
 
-    def eval(self):
-        self.flag_trace = True # start from the front
-        args = {}
+    def eval(self, input_args, trace=True):
+        """Run main with the given command-line arguments
+
+        trace: record the hot loops into trace.json (interp engine only)
+        """
+        self.run(input_args, self.stdout, "trace.json" if trace else None)
+
+    def run(self, input_args, stdout=None, trace=None):
+        """Run main on fresh state, so that a loaded program can be run
+        many times, and return the result of the run as a dict
+
+        input_args: arguments of main, as strings or numbers
+        stdout: file receiving the output (default: kept in the result)
+        trace: file to write the traces of the hot loops into (default: no
+               tracing), which are only recorded by the interp and
+               tracejit engines
+        """
+        self.reset()
+        self.out = stdout if stdout is not None else io.StringIO()
+        frame = self.main_frame(input_args)
+        if self.engine == "pyjit":
+            # compiled blocks are not traced
+            retval = self.eval_compiled(frame)
+        else:
+            # tracejit also runs the compiled traces of the hot loops
+            self.flag_trace = trace is not None or self.engine == "tracejit"
+            if self.flag_trace:
+                retval = self.eval_traced(frame)
+                if trace is not None:
+                    self.print_trace(trace)
+            else:
+                retval = self.eval_frame(frame)
+        self.report()
+        return {"output": self.out.getvalue() if stdout is None else None,
+                "retval": retval,
+                "instr_count": self.instr_count,
+                "trace": self.trace_program() if self.flag_trace else None}
+
+    def main_frame(self, input_args):
+        """Return the frame of main with the command-line arguments
+        """
+        args = []
         if "args" in self.main:
             for i, arg in enumerate(self.main["args"]):
                 if arg["type"] in ["int", "bool"]:
@@ -92,120 +198,356 @@ class VirtualMachine(object):
                     val = float(input_args[i])
                 else:
                     raise RuntimeError("Not supported types")
-                args[arg["name"]] = val
-        self.eval_frame(Frame("main", self.funcs["main"]["instrs"], args))
+                args.append(val)
+        return Frame(self.funcs["main"], args)
+
+    def report(self):
+        """Print the summary of a finished run
+        """
         # self.detect_memory_leak()
-        self.print_trace()
-        print("# of instructions:", self.instr_count)
+        print("# of instructions:", self.instr_count, file=self.out)
 
-    def eval_frame(self, frame) -> None:
-        pc = 0
-        while pc < len(frame.instrs):
-            instr = frame.instrs[pc]
-            if self.flag_trace:
-                self.add_instr_to_trace(instr, frame)
-            # print(frame.data)
-            # print(instr)
-            pc += 1
-            if "label" in instr:
-                continue
-            elif "op" in instr:
-                self.instr_count += 1
-                if instr["op"] == "const":
-                    frame.eval_const(instr)
-                elif instr["op"] == "id":
-                    frame.data[instr["dest"]] = frame.data[instr["args"][0]]
-                    if instr["args"][0] in self.allocated:
-                        self.reference_count[instr["args"][0]] += 1
-                elif instr["op"] in ["neg", "not"]:
-                    frame.eval_unary_op(instr)
-                elif instr["op"] in ["add", "sub", "mul", "div", "or", "and"]:
-                    frame.eval_binary_op(instr)
-                elif instr["op"] in ["lt", "gt", "eq", "ne", "le", "ge"]:
-                    frame.eval_compare_op(instr)
-                elif instr["op"] == "jmp":
-                    pc = frame.blocks[instr["labels"][0]]
-                elif instr["op"] == "br":
-                    if frame.data[instr["args"][0]]: # true
-                        pc = frame.blocks[instr["labels"][0]]
-                    else: # false
-                        pc = frame.blocks[instr["labels"][1]]
-                elif instr["op"] == "alloc": # return the address
-                    # test if overwriting the original memory
-                    if instr["dest"] in self.allocated:
-                        self.decrease_reference_count(frame.data[instr["dest"]], instr["dest"])
-                    frame.data[instr["dest"]] = self.memory_ptr
-                    self.memory_ptr += frame.data[instr["args"][0]]
-                    self.allocated[instr["dest"]] = frame.data[instr["args"][0]]
-                    if self.memory_ptr > MEMORY_SIZE:
-                        raise RuntimeError("Out of memory")
-                    for loc in range(frame.data[instr["dest"]], self.memory_ptr):
-                        self.memory_usage[loc] = True
-                    self.reference_count[instr["dest"]] = 1
-                elif instr["op"] == "free":
-                    ptr = frame.data[instr["args"][0]]
-                    size = self.allocated[instr["args"][0]]
-                    self.free_memory(ptr, size)
-                    self.reference_count[instr["args"][0]] = 0
-                elif instr["op"] == "ptradd":
-                    frame.data[instr["dest"]] = frame.data[instr["args"][0]] + frame.data[instr["args"][1]]
-                elif instr["op"] == "load":
-                    frame.data[instr["dest"]] = self.memory[frame.data[instr["args"][0]]]
-                elif instr["op"] == "store":
-                    self.memory[frame.data[instr["args"][0]]] = frame.data[instr["args"][1]]
-                elif instr["op"] == "call":
-                    args = {}
-                    if "args" in instr:
-                        for outer_arg, func_arg in zip(instr["args"], self.funcs[instr["funcs"][0]]["args"]):
-                            args[func_arg["name"]] = frame.data[outer_arg]
-                    res = self.eval_frame(Frame(instr["funcs"][0], self.funcs[instr["funcs"][0]]["instrs"], args))
-                    if "dest" in instr:
-                        frame.data[instr["dest"]] = res
-                elif instr["op"] == "ret":
-                    if "args" in instr:
-                        for var in frame.data:
-                            if var in self.allocated and var != instr["args"][0]:
-                                self.decrease_reference_count(frame.data[var], var)
-                        return frame.data[instr["args"][0]]
-                    else:
-                        for var in frame.data:
-                            if var in self.allocated:
-                                self.decrease_reference_count(frame.data[var], var)
-                        return
-                elif instr["op"] == "print":
-                    print(frame.data[instr["args"][0]])
-                # speculative execution
-                elif instr["op"] == "speculate":
-                    self.spec_data = frame.data.copy()
-                elif instr["op"] == "commit":
-                    self.spec_data = {} # done successfully
-                elif instr["op"] == "guard":
-                    if not frame.data[instr["args"][0]]: # exit from speculation
-                        frame.data = self.spec_data.copy() # recover data
-                        pc = frame.blocks[instr["labels"][0]]
-                else:
-                    raise RuntimeError("Unknown instruction: {}".format(instr["op"]))
-        # implicit return
-        for var in frame.data:
-            if var in self.allocated:
-                self.decrease_reference_count(frame.data[var], var)
-
-    def decrease_reference_count(self, ptr, var):
-        self.reference_count[var] -= 1
-        if self.reference_count[var] == 0:
-            self.free_memory(ptr, self.allocated[var])
-            print("Free memory:", var)
-
-    def free_memory(self, ptr, size):
-        for loc in range(ptr, ptr+size):
-            if not self.memory_usage[loc]:
-                raise RuntimeError("Double free")
-            self.memory_usage[loc] = False
+    def eval_frame(self, frame):
+        """Run frame until the call stack is empty. Calls and returns do not
+        recurse in Python, they switch the running frame and its pc
+        """
+        self.frame = frame
+        handlers = self.handlers
+        count = 0
+        while frame is not None:
+            instrs = frame.instrs
+            pc = frame.pc
+            while pc >= 0:
+                instr = instrs[pc]
+                count += 1
+                pc = handlers[instr[0]](self, frame, instr, pc + 1)
+            frame = self.frame
+        self.instr_count += count
+        return self.retval
+
+    def eval_traced(self, frame):
+        """Run frame like eval_frame, counting the back edges taken to every
+        loop header, and record one iteration of the loops that get hot
+        """
+        self.frame = frame
+        count = 0
+        while frame is not None:
+            # the trace needs every call to be executed, and every
+            # instruction of a superinstruction
+            instrs = frame.func.instrs
+            pc = frame.pc
+            while pc >= 0:
+                instr = instrs[pc]
+                if self.recording is not None:
+                    self.record(frame, pc)
+                elif self.following is not None:
+                    self.follow(frame, pc)
+                count += 1
+                next_pc = HANDLERS[instr[0]](self, frame, instr, pc + 1)
+                if 0 <= next_pc <= pc: # back edge
+                    next_pc = self.back_edge(frame, next_pc)
+                pc = next_pc
+            frame = self.frame
+        self.instr_count += count
+        return self.retval
+
+    def eval_compiled(self, frame):
+        """Run frame with the pyjit engine, which jumps between the compiled
+        basic blocks instead of interpreting each instruction
+        """
+        self.frame = frame
+        while frame is not None:
+            blocks = frame.func.blocks
+            if blocks is None:
+                blocks = frame.func.blocks = Compiler(frame.func, HANDLERS).compile()
+            data = frame.data
+            pc = frame.pc
+            while pc >= 0:
+                pc = blocks[pc](self, frame, data)
+            frame = self.frame
+        return self.retval
+
+    def alloc(self, site, size, heap):
+        """Return a pointer to a new block, which nothing references yet
+
+        site: (function, variable, pc) of the alloc instruction
+        """
+        start = self.heaps[heap].alloc(size)
+        alloc = Allocation(heap, start, size, site)
+        self.allocations.add(alloc)
+        if self.census is not None:
+            self.census.count(self)
+        return Pointer(alloc, start)
+
+    def free(self, ptr):
+        alloc = ptr.alloc
+        if not alloc.live:
+            raise RuntimeError("Double free of {}".format(alloc))
+        if ptr.addr != alloc.start:
+            raise RuntimeError("Free of a pointer inside {}".format(alloc))
+        self.reclaim(alloc)
+
+    def set_pointer(self, data, index, ptr):
+        """Write ptr into a register or a pointer cell, which then references
+        its allocation instead of the one of the old pointer
+        """
+        old = data[index]
+        data[index] = ptr
+        if old is not None and ptr is not None and old.alloc is ptr.alloc:
+            return # e.g., a loop moving a pointer in an array
+        if ptr is not None:
+            ptr.alloc.refs += 1
+        if old is not None:
+            self.release(old.alloc)
+
+    def retain_slots(self, data, slots):
+        """Count a reference more for the pointers in the given registers,
+        e.g., for the arguments of a called frame
+        """
+        for slot in slots:
+            if data[slot] is not None:
+                data[slot].alloc.refs += 1
+
+    def release_slots(self, data, slots):
+        for slot in slots:
+            if data[slot] is not None:
+                self.release(data[slot].alloc)
+
+    def release_frame(self, frame, result=None):
+        """Decrease the reference counts of the pointers going out of scope,
+        which are only the pointer variables of the function
+
+        result: returned pointer, whose reference moves to the caller
+        """
+        if result is not None:
+            result.alloc.refs += 1
+        self.release_slots(frame.data, frame.func.pointers)
+
+    def release(self, alloc):
+        alloc.refs -= 1
+        if alloc.refs == 0 and alloc.live:
+            self.reclaim(alloc)
+            print("Free memory:", alloc.site[1], file=self.out)
+
+    def reclaim(self, alloc):
+        alloc.live = False
+        self.allocations.remove(alloc)
+        self.heaps[alloc.heap].free(alloc.start)
+        if alloc.heap == POINTER_HEAP: # release the pointers it holds
+            cells = self.cells[POINTER_HEAP]
+            for addr in range(alloc.start, alloc.start + alloc.size):
+                if cells[addr] is not None:
+                    self.set_pointer(cells, addr, None)
+
+    def clear_journal(self):
+        """Drop the journal at the end of the outermost speculation
+        """
+        if self.journal_refs > 0:
+            for heap, addr, value in self.journal:
+                if heap == POINTER_HEAP and value is not None:
+                    self.release(value.alloc)
+        self.journal = []
+        self.journal_refs = 0
+
+    def abort(self):
+        """Undo the writes of the innermost speculation, newest first
+        """
+        spec = self.speculations.pop()
+        journal = self.journal
+        while len(journal) > spec.mark:
+            heap, addr, value = journal.pop()
+            cells = self.cells[heap]
+            old = cells[addr]
+            cells[addr] = value # with the reference of the journal
+            if heap == POINTER_HEAP:
+                if value is not None:
+                    self.journal_refs -= 1
+                if old is not None:
+                    self.release(old.alloc)
+        data = spec.frame.data
+        current = [data[slot] for slot in spec.instr[2]]
+        for slot, value in zip(spec.instr[1], spec.saved):
+            data[slot] = value # with the reference of the speculation
+        for ptr in current:
+            if ptr is not None:
+                self.release(ptr.alloc)
+
+    def journal_cell(self, heap, addr):
+        """Save the value of a cell before its first write in the innermost
+        speculation
+        """
+        spec = self.speculations[-1]
+        if spec.logged is None:
+            spec.logged = set()
+        if (heap, addr) not in spec.logged:
+            spec.logged.add((heap, addr))
+            value = self.cells[heap][addr]
+            if heap == POINTER_HEAP and value is not None:
+                value.alloc.refs += 1 # held by the journal
+                self.journal_refs += 1
+            self.journal.append((heap, addr, value))
 
     def detect_memory_leak(self):
-        for loc in range(MEMORY_SIZE):
-            if self.memory_usage[loc]:
-                raise RuntimeError("Memory leak at loc {}".format(loc))
+        """Report every allocation still live, which only takes a walk over
+        the live allocations, not over the heaps
+        """
+        if self.allocations:
+            leaks = sorted(self.allocations, key=lambda alloc: (alloc.site[0], alloc.site[2], alloc.start))
+            raise RuntimeError("Memory leak:\n" + "\n".join("  {}, {} cells at loc {}".format(alloc, alloc.size, alloc.start)
+                                                             for alloc in leaks))
+
+    def back_edge(self, frame, header):
+        """Count a back edge to header, and start tracing its loop from there
+        once it is hot. Return the pc to continue from, which is the one
+        where the compiled tree of the loop exits, if there is one
+        """
+        loop = (frame.func.name, header)
+        if self.recording is None:
+            if loop in self.compiled:
+                return self.compiled[loop](self, frame, frame.data)
+            if loop in self.trees and self.following is None:
+                self.following = (self.trees[loop], 0, frame)
+        hotness = self.hotness[loop] = self.hotness.get(loop, 0) + 1
+        if hotness >= self.hot_loop and self.recording is None and loop not in self.traced:
+            self.traced.add(loop)
+            entry = min(label for label, pc in frame.func.labels.items() if pc == header)
+            self.start_trace(frame, header, "{}.{}".format(frame.func.name, entry))
+        return header
+
+    def start_trace(self, frame, header, name, parent_exit=None, context=([], 0)):
+        """Record the trace of the loop of frame from the next instruction,
+        which is the header, or the other target of the branch of a side
+        exit, where context is the calls inlined by the parent trace
+        """
+        self.following = None
+        self.recording = (frame, header)
+        self.parent_exit = parent_exit
+        self.trace_name = name
+        self.trace_length = 0
+        self.trace = []
+        self.path = []
+        self.contexts = {}
+        self.pure = True
+        self.call_ret = list(context[0])
+        self.num_inlined = context[1]
+        self.written = []
+
+    def exit_taken(self, trace, index, frame):
+        """Count a side exit of trace, at the branch at index of its path,
+        and start tracing from there once it is hot
+        """
+        exits = trace.exits[index] = trace.exits.get(index, 0) + 1
+        if exits == self.hot_loop and self.recording is None and trace.level < MAX_TREE_DEPTH:
+            name = "{}.{}".format(trace.name, index)
+            self.start_trace(frame, trace.header, name, (trace, index), trace.contexts[index])
+
+    def follow(self, frame, pc):
+        """Check that the instruction at pc is the next one of the iteration
+        along the tree of the loop, which the interp engine does not run,
+        to count the side exits taken in the function of the loop
+        """
+        trace, index, loop_frame = self.following
+        depth, func, traced_pc, taken = trace.path[index]
+        instr = frame.func.instrs[pc]
+        if func is not frame.func or traced_pc != pc: # left the tree another way, like an abort
+            self.following = None
+        elif instr[0] == BR and bool(frame.data[instr[1]]) != taken:
+            self.following = None
+            side = trace.branches.get(index)
+            if side is not None and side.path:
+                self.following = (side, 0, loop_frame)
+            elif side is None and depth == 0:
+                self.exit_taken(trace, index, loop_frame)
+        elif index + 1 < len(trace.path):
+            self.following = (trace, index + 1, loop_frame)
+        else:
+            self.following = None # next iteration
+
+    def record(self, frame, pc):
+        """Add the instruction at pc to the trace, which ends when the loop
+        is back to its header, and is given up when it is too long, leaves
+        the function of the loop, or speculates
+        """
+        loop_frame, header = self.recording
+        if frame is loop_frame and pc == header and (self.trace_length > 0 or self.parent_exit is not None):
+            self.finish_trace()
+            return
+        instr = frame.func.source[pc]
+        branch = frame.func.instrs[pc][0] == BR
+        self.path.append((len(self.call_ret), frame.func, pc, branch and bool(frame.data[frame.func.instrs[pc][1]])))
+        if branch:
+            self.contexts[len(self.path) - 1] = (list(self.call_ret), self.num_inlined)
+        if instr is None or instr["op"] == "ret": # end of a function
+            if frame is loop_frame:
+                self.recording = None
+                return
+            instr = {"op": "ret", "args": []} if instr is None else instr
+        elif instr["op"] in ["speculate", "commit", "guard"]:
+            self.recording = None
+            return
+        elif instr["op"] in ["print", "free"]:
+            self.pure = False
+        self.trace_length += 1
+        if self.trace_length > self.max_trace_length:
+            self.recording = None
+            return
+        self.add_instr_to_trace(instr, frame)
+
+    def finish_trace(self):
+        """Add the trace to the tree of the loop, compiled again for
+        tracejit, and save it as a function of the variables that it reads
+        before writing them if a failing guard can undo it. Its guards in
+        the function of the loop, and its final commit, carry the
+        deoptimization metadata of deopt(). A side trace is only saved if
+        its parent is, and if it starts in the function of the loop
+        """
+        frame, header = self.recording
+        func = frame.func
+        self.recording = None
+        loop = (func.name, header)
+        if self.parent_exit is None:
+            trace = self.trees[loop] = Trace(self.trace_name, func, header, self.path, self.contexts)
+        else:
+            parent, index = self.parent_exit
+            trace = parent.branches[index] = Trace(self.trace_name, func, header, self.path, self.contexts, parent)
+        if self.engine == "tracejit":
+            self.compiled[loop] = TraceCompiler(trace.root, self.funcs, HANDLERS).compile()
+        if not self.pure or (trace.parent is not None and (not parent.exported or parent.path[index][0] > 0)):
+            return
+        trace.exported = True
+        entry = min(label for label, pc in func.labels.items() if pc == header)
+        # the end of the iteration is an exit too, where all the variables are live
+        commit = {"op": "commit"}
+        commit.update(self.deopt())
+        self.trace.append(commit)
+        defined = set()
+        live_in = []
+        for instr in self.trace:
+            for arg in instr.get("args", []):
+                if arg not in defined and arg not in live_in:
+                    live_in.append(arg)
+            if "dest" in instr:
+                defined.add(instr["dest"])
+        saved = {"name": trace.name, "func": func.name, "entry": entry,
+                 "args": [{"name": var, "type": func.types[var]} for var in live_in],
+                 "instrs": self.trace}
+        if trace.parent is not None:
+            saved["parent"] = trace.parent.name
+        self.traces.append(saved)
+
+    def renamed(self, var):
+        """Return the name of var in the trace, where the variables of the
+        inlined calls get the number of their call as suffix
+        """
+        return var if not self.call_ret else "{}.{}".format(var, self.call_ret[-1][0])
+
+    def deopt(self):
+        """Return the deoptimization metadata of an exit of the trace: the
+        variables of the function of the loop written by the trace so far,
+        as extra args of the exit, so that the optimizations of the trace
+        rename them like any other use, and their original names and types
+        """
+        return {"args": [var for var, _ in self.written], "vars": [{"name": var, "type": typ} for var, typ in self.written]}
 
     def add_instr_to_trace(self, instr, frame):
         if "op" not in instr:
@@ -213,55 +555,110 @@ class VirtualMachine(object):
         elif instr["op"] == "jmp":
             pass
         elif instr["op"] == "br":
-            if frame.data[instr["args"][0]]: # true
+            cond = self.renamed(instr["args"][0])
+            if frame.data[frame.func.slots[instr["args"][0]]]: # true
                 jmp = instr["labels"][1]
-                args = instr["args"]
             else:
                 jmp = instr["labels"][0]
-                args = ["not_cond"]
-                self.trace.append({"op": "not", "dest": "not_cond", "args": instr["args"]})
-            new_instr = {"op": "guard", "args": args, "labels": [jmp]} # false branch
+                not_cond = self.renamed("not_cond")
+                self.trace.append({"op": "not", "dest": not_cond, "args": [cond], "type": "bool"})
+                cond = not_cond
+            new_instr = {"op": "guard", "args": [cond], "labels": [jmp]} # false branch
+            if not self.call_ret: # the exit resumes at jmp in the function of the loop
+                deopt = self.deopt()
+                new_instr["args"] += deopt["args"]
+                new_instr["vars"] = deopt["vars"]
+                new_instr["exit"] = "{}.{}".format(self.trace_name, len(self.path) - 1) # name of its side trace
             self.trace.append(new_instr)
         elif instr["op"] == "call": # interprocedural
             func = self.funcs[instr["funcs"][0]]
-            for i, arg in enumerate(instr["args"]):
-                new_instr = {"op": "id", "dest": func["args"][i]["name"], "args": [arg], "type": func["args"][i]["type"]}
+            self.num_inlined += 1
+            args = [self.renamed(arg) for arg in instr["args"]]
+            dest = self.renamed(instr["dest"]) if "dest" in instr else None
+            if dest is not None and not self.call_ret:
+                self.write(instr["dest"], instr["type"])
+            self.call_ret.append((self.num_inlined, dest, instr.get("type")))
+            for i, arg in enumerate(args):
+                new_instr = {"op": "id", "dest": self.renamed(func.args[i]["name"]), "args": [arg], "type": func.args[i]["type"]}
                 self.trace.append(new_instr)
-            if "dest" in instr:
-                self.call_ret.append((instr["dest"], instr["type"]))
-            else:
-                self.call_ret.append(None)
         elif instr["op"] == "ret":
-            if self.call_ret[-1] == None:
+            _, dest, typ = self.call_ret[-1]
+            if dest is None:
                 self.call_ret.pop()
             else:
-                new_instr = {"op": "id", "dest": self.call_ret[-1][0], "args": [instr["args"][0]], "type": self.call_ret[-1][1]}
+                value = self.renamed(instr["args"][0])
                 self.call_ret.pop()
-                self.trace.append(new_instr)
+                self.trace.append({"op": "id", "dest": dest, "args": [value], "type": typ})
         else:
-            self.trace.append(instr)
+            new_instr = dict(instr)
+            if "args" in instr:
+                new_instr["args"] = [self.renamed(arg) for arg in instr["args"]]
+            if "dest" in instr:
+                if not self.call_ret:
+                    self.write(instr["dest"], instr["type"])
+                new_instr["dest"] = self.renamed(instr["dest"])
+            self.trace.append(new_instr)
 
-    def print_trace(self):
-        program = {}
-        if "args" in self.main:
-            program["functions"] = [{"instrs": self.trace, "args": self.main["args"], "name": "main"}]
-        else:
-            program["functions"] = [{"instrs": self.trace, "name": "main"}]
-        with open("trace.json", "w") as outfile:
-            outfile.write(json.dumps(program, indent=2))
+    def write(self, var, typ):
+        if (var, typ) not in self.written:
+            self.written.append((var, typ))
+
+    def trace_program(self):
+        """Return the traces as a program with one function per trace of
+        every hot loop, which also names the function of the loop, its
+        header label and the parent of a side trace
+        """
+        return {"functions": self.traces}
+
+    def print_trace(self, filename="trace.json"):
+        with open(filename, "w") as outfile:
+            outfile.write(json.dumps(self.trace_program(), indent=2))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process command line arguments')
     parser.add_argument('-f', dest='file', default="", help='get input file')
+    parser.add_argument('--engine', default="interp", choices=["interp", "pyjit", "tracejit"], help='execution engine')
+    parser.add_argument('--max-depth', dest='max_depth', type=int, default=MAX_STACK_DEPTH, help='maximum depth of the Bril call stack')
+    parser.add_argument('--batch', default="", help='run once per line of arguments in this file (needs NumPy)')
+    parser.add_argument('--profile', default="", help='write an execution profile to this file')
+    parser.add_argument('--memoize', dest='memo_size', type=int, default=0, help='cache up to this many results of pure functions')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='do not use the decoded program cache (.brilc)')
+    parser.add_argument('--alloc', default="best", choices=POLICIES, help='fit policy of the heap allocator')
+    parser.add_argument('--census', default="", help='write the live bytes of every allocation site over time to this file')
+    parser.add_argument('--census-every', dest='census_every', type=int, default=1000, help='allocations between two census samples')
+    parser.add_argument('--heap-stats', dest='heap_stats', action='store_true', help='report the heap usage and fragmentation')
+    parser.add_argument('--hot-loop', dest='hot_loop', type=int, default=HOT_LOOP, help='back edges to a loop header before tracing the loop')
+    parser.add_argument('--max-trace', dest='max_trace', type=int, default=MAX_TRACE_LENGTH, help='executed instructions before giving up a trace')
     parser.add_argument('args', nargs='*')
     args = parser.parse_args()
     if args.file != "":
-        with open(args.file, "r") as infile:
-            program = json.load(infile)
-        input_args = sys.argv[3:]
+        program, funcs = load_program(args.file, args.cache)
     else:
         program = json.loads(''.join(sys.stdin.readlines())) # already in json format
-        input_args = sys.argv
+        funcs = None
 
-    bvm = VirtualMachine(program)
-    bvm.eval()
\ No newline at end of file
+    if args.batch != "":
+        from batch import run_batch
+        run_batch(program, VirtualMachine, args.batch, funcs)
+    else:
+        bvm = VirtualMachine(program, args.engine, args.max_depth, funcs=funcs, memo_size=args.memo_size,
+                             alloc_policy=args.alloc)
+        if args.census != "":
+            bvm.census = Census(args.census_every)
+        bvm.hot_loop = args.hot_loop
+        bvm.max_trace_length = args.max_trace
+        if args.profile != "":
+            profiler = Profiler(bvm)
+            profiler.eval(args.args)
+            profiler.dump(args.profile)
+        else:
+            bvm.eval(args.args, trace=bvm.memo is None) # memoized calls are not traced
+        if bvm.memo is not None:
+            bvm.memo.report()
+        if bvm.census is not None:
+            bvm.census.dump(args.census)
+        if args.heap_stats:
+            for kind, heap in enumerate(bvm.heaps):
+                if heap.num_allocs > 0:
+                    for key, value in heap.stats().items():
+                        print("heap {} {}: {}".format(HEAP_NAMES[kind], key, value), file=sys.stderr)
\ No newline at end of file
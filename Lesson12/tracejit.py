@@ -0,0 +1,215 @@
+"""Compile the recorded trace of a hot loop into a Python function
+
+A trace is the path of one iteration of the loop, as (depth, function, pc,
+taken) entries, where depth counts the calls inlined since the header and
+taken is the direction of a branch. The compiled function runs the
+iterations of the loop on the registers of the frame of the loop for as
+long as the branches go the traced way. The inlined calls get a frame of
+their own, whose registers are Python locals, so that a branch going the
+other way (a side exit) only has to suspend these frames on the call stack
+of the VM and resume the interpreter at the other target of the branch:
+
+    def trace_main_loop(vm, frame, data):
+        while True:
+            data[4] = data[1] < data[2]
+            if not data[4]:
+                vm.instr_count += 2
+                return 9 # pc of the other target
+            ...
+            vm.instr_count += 12 # the whole iteration
+
+It returns the pc to resume the frame of the loop from, or -1 when the
+side exit resumes in an inlined frame (vm.frame). Instructions without a
+code template call their interpreter handler, like in pyjit.
+
+The traces of a loop form a tree: a side exit taken often enough gets a
+trace of its own, from the other target of the branch back to the header,
+which is compiled in place of the side exit, so that the loop stays in
+the compiled function whichever way the branch goes:
+
+            if not data[4]:
+                data[6] = data[1] + data[3] # the side trace
+                ...
+                vm.instr_count += 9
+                continue
+"""
+
+from bytecode import *
+from heap import Pointer
+from ops import store_wide
+from pyjit import BINARY_SYMBOLS
+
+MAX_TREE_DEPTH = 16 # side traces of side traces, nested in the compiled tree
+
+
+class Trace(object):
+    """A trace of the tree of a loop
+
+    name: function.label of the header, with the path index of the exit of
+    every parent for a side trace
+    path: (depth, function, pc, taken) of every executed instruction
+    contexts: path index of a branch->(inlined calls, number of calls
+    inlined so far) there, for the side trace that starts after it
+    branches: path index of a branch->side trace of its other way
+    exits: path index of a branch->times its side exit was taken
+    """
+
+    def __init__(self, name, func, header, path, contexts, parent=None) -> None:
+        self.name = name
+        self.func = func
+        self.header = header
+        self.path = path
+        self.contexts = contexts
+        self.parent = parent
+        self.root = self if parent is None else parent.root
+        self.level = 0 if parent is None else parent.level + 1
+        self.branches = {}
+        self.exits = {}
+        self.exported = False # saved in the trace program
+
+
+class TraceCompiler(object):
+    """Generate the Python source of the tree of traces of a loop
+
+    tree: Trace at the root of the tree
+    funcs: decoded functions of the program, for the inlined calls
+    handlers: interpreter handlers of the instructions without a template
+    """
+
+    def __init__(self, tree, funcs, handlers) -> None:
+        self.tree = tree
+        self.funcs = funcs
+        self.handlers = handlers
+        self.consts = []
+
+    def const(self, value):
+        if type(value) in (int, bool):
+            return repr(value)
+        self.consts.append(value)
+        return "K[{}]".format(len(self.consts) - 1)
+
+    @staticmethod
+    def regs(depth):
+        return "data" if depth == 0 else "r{}".format(depth)
+
+    @staticmethod
+    def frame(depth):
+        return "frame" if depth == 0 else "f{}".format(depth)
+
+    def side_exit(self, lines, ind, executed, depth, calls, target):
+        """Leave the trace at pc target of the frame at depth, after moving
+        the inlined frames to the call stack
+        """
+        lines.append("{}vm.instr_count += {}".format(ind, executed))
+        if depth == 0:
+            lines.append("{}return {}".format(ind, target))
+            return
+        for caller, (pc, dest) in enumerate(calls):
+            lines.append("{}{}.pc = {}".format(ind, self.frame(caller), pc))
+            lines.append("{}{}.dest = {}".format(ind, self.frame(caller), dest))
+            lines.append("{}vm.stack.append({})".format(ind, self.frame(caller)))
+        lines.append("{}{}.pc = {}".format(ind, self.frame(depth), target))
+        lines.append("{}vm.frame = {}".format(ind, self.frame(depth)))
+        lines.append("{}return -1".format(ind))
+
+    def compile_instr(self, lines, ind, depth, func, pc, taken, executed, calls):
+        """Generate the code of an instruction that is not a branch
+        """
+        instr = func.instrs[pc]
+        op = instr[0]
+        r = self.regs(depth)
+        if op == CONST:
+            lines.append("{}{}[{}] = {}".format(ind, r, instr[1], self.const(instr[2])))
+        elif op == ID and not instr[3]:
+            lines.append("{}{}[{}] = {}[{}]".format(ind, r, instr[1], r, instr[2]))
+        elif op in BINARY_SYMBOLS:
+            lines.append("{}{}[{}] = {}[{}] {} {}[{}]".format(ind, r, instr[1], r, instr[2], BINARY_SYMBOLS[op], r, instr[3]))
+        elif op == DIV:
+            lines.append("{}{}[{}] = int_div({}[{}], {}[{}])".format(ind, r, instr[1], r, instr[2], r, instr[3]))
+        elif op == NEG:
+            lines.append("{}{}[{}] = -{}[{}]".format(ind, r, instr[1], r, instr[2]))
+        elif op == NOT:
+            lines.append("{}{}[{}] = not {}[{}]".format(ind, r, instr[1], r, instr[2]))
+        elif op == PTRADD:
+            # moving within the same allocation changes no reference count
+            lines.append("{}base = {}[{}]".format(ind, r, instr[2]))
+            lines.append("{}ptr = Pointer(base.alloc, base.addr + {}[{}])".format(ind, r, instr[3]))
+            lines.append("{}if {}[{}] is not None and {}[{}].alloc is base.alloc:".format(ind, r, instr[1], r, instr[1]))
+            lines.append("{}    {}[{}] = ptr".format(ind, r, instr[1]))
+            lines.append("{}else:".format(ind))
+            lines.append("{}    vm.set_pointer({}, {}, ptr)".format(ind, r, instr[1]))
+        elif op == LOAD and instr[3] != POINTER_HEAP:
+            lines.append("{}{}[{}] = vm.cells[{}][{}[{}].addr]".format(ind, r, instr[1], instr[3], r, instr[2]))
+        elif op == STORE and not instr[4] and instr[3] != POINTER_HEAP:
+            lines.append("{}try:".format(ind))
+            lines.append("{}    vm.cells[{}][{}[{}].addr] = {}[{}]".format(ind, instr[3], r, instr[1], r, instr[2]))
+            lines.append("{}except (OverflowError, TypeError):".format(ind))
+            lines.append("{}    store_wide(vm, {}, {}[{}].addr, {}[{}])".format(ind, instr[3], r, instr[1], r, instr[2]))
+        elif op == JMP or op == NOP:
+            pass
+        elif op == CALL:
+            callee = self.frame(depth + 1)
+            args = "".join("{}[{}], ".format(r, arg) for arg in instr[3])
+            lines.append("{}if len(vm.stack) + {} >= vm.max_depth:".format(ind, depth))
+            lines.append("{}    raise RuntimeError(\"Stack overflow: more than {{}} frames\".format(vm.max_depth))".format(ind))
+            lines.append("{}{} = Frame(vm.funcs[{!r}], [{}])".format(ind, callee, instr[2], args))
+            lines.append("{}{} = {}.data".format(ind, self.regs(depth + 1), callee))
+            if self.funcs[instr[2]].pointer_args:
+                lines.append("{}vm.retain_slots({}, {}.func.pointer_args)".format(ind, self.regs(depth + 1), callee))
+            calls.append((pc + 1, instr[1]))
+        elif op in (RET, END):
+            # back to the caller, like leave()
+            pointer = op == RET and instr[2]
+            value = "{}[{}]".format(r, instr[1]) if op == RET and instr[1] >= 0 else "None"
+            lines.append("{}value = {}".format(ind, value))
+            if func.pointers:
+                lines.append("{}vm.release_frame({}, {})".format(ind, self.frame(depth), "value" if pointer else "None"))
+            _, dest = calls.pop()
+            caller = self.regs(depth - 1)
+            if dest >= 0 and pointer:
+                lines.append("{}old = {}[{}]".format(ind, caller, dest))
+                lines.append("{}{}[{}] = value".format(ind, caller, dest))
+                lines.append("{}if old is not None:".format(ind))
+                lines.append("{}    vm.release(old.alloc)".format(ind))
+            elif dest >= 0:
+                lines.append("{}{}[{}] = value".format(ind, caller, dest))
+            elif pointer:
+                lines.append("{}if value is not None:".format(ind))
+                lines.append("{}    vm.release(value.alloc)".format(ind))
+        else:
+            self.consts.append(instr)
+            lines.append("{}H[{}](vm, {}, K[{}], {})".format(ind, op, self.frame(depth), len(self.consts) - 1, pc + 1))
+
+    def compile_trace(self, lines, ind, trace, executed, calls):
+        """Generate the code of trace up to the next iteration, after
+        executed instructions of its parents and with calls, the (pc to
+        resume the caller at, result slot) of the calls they inlined
+        """
+        for i, (depth, func, pc, taken) in enumerate(trace.path):
+            instr = func.instrs[pc]
+            if instr[0] != END: # implicit return is not an instruction
+                executed += 1
+            if instr[0] != BR:
+                self.compile_instr(lines, ind, depth, func, pc, taken, executed, calls)
+                continue
+            # the other way is a side exit, or a side trace
+            lines.append("{}if {}{}[{}]:".format(ind, "not " if taken else "", self.regs(depth), instr[1]))
+            if i in trace.branches:
+                self.compile_trace(lines, ind + "    ", trace.branches[i], executed, list(calls))
+                continue
+            self.consts.append(trace)
+            lines.append("{}    vm.exit_taken(K[{}], {}, frame)".format(ind, len(self.consts) - 1, i))
+            self.side_exit(lines, ind + "    ", executed, depth, calls, instr[3] if taken else instr[2])
+        lines.append("{}vm.instr_count += {}".format(ind, executed))
+        lines.append("{}continue".format(ind))
+
+    def compile(self):
+        """Return the compiled tree
+        """
+        lines = ["def trace(vm, frame, data):", "    while True:"]
+        self.compile_trace(lines, "        ", self.tree, 0, [])
+        source = "\n".join(lines)
+        env = {"K": self.consts, "H": self.handlers, "Frame": Frame, "Pointer": Pointer,
+               "int_div": int_div, "store_wide": store_wide}
+        exec(compile(source, "<trace {}>".format(self.tree.name), "exec"), env)
+        return env["trace"]
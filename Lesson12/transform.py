@@ -2,30 +2,145 @@ import sys
 import json
 import argparse
 
-def find_main(prg):
+# instructions that only write their dest, which a guard before anything
+# else in the trace can leave without undoing
+PURE_OPS = ["const", "id", "add", "sub", "mul", "div", "and", "or", "not", "neg",
+            "eq", "lt", "gt", "le", "ge", "ne",
+            "fadd", "fsub", "fmul", "fdiv", "feq", "flt", "fgt", "fle", "fge",
+            "ptradd", "load", "nop"]
+
+def find_func(prg, name):
     for func in prg["functions"]:
-        if func["name"] == "main":
+        if func["name"] == name:
             return func
 
+def live_vars(func):
+    """Return the variables live at every label of func
+    """
+    instrs = func["instrs"]
+    index = {instr["label"]: i for i, instr in enumerate(instrs) if "label" in instr}
+    live = [set() for _ in range(len(instrs) + 1)]
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(range(len(instrs))):
+            instr = instrs[i]
+            out = set() if instr.get("op") in ["jmp", "br", "ret"] else live[i + 1]
+            for label in instr.get("labels", []):
+                out = out | live[index[label]]
+            new = (out - {instr.get("dest")}) | set(instr.get("args", []))
+            if new != live[i]:
+                live[i] = new
+                changed = True
+    return {label: live[i] for label, i in index.items()}
+
+def restore(guard, values, live):
+    """Copy the values of the trace back into the original variables that
+    are live, from the deoptimization metadata of an exit
+    """
+    return [{"op": "id", "dest": var["name"], "type": var["type"], "args": [value]}
+            for value, var in zip(values, guard["vars"]) if value != var["name"] and var["name"] in live]
+
+def region(trace, sides, abort, live):
+    """Return the code running trace, followed by the stubs of its exits
+    and by the regions of its side traces, where live is the variables
+    live at every label of the original function
+
+    A guard of the function of the loop exits through a stub that restores
+    the original variables and resumes at the branch target that the guard
+    rules out, or at the region of the side trace of this exit if there is
+    one. Guards with the same resume point and restored values share a
+    stub, and a guard with nothing to restore branches to its target right
+    away. A guard of an inlined call resumes at abort, where the trace
+    started. Up to the first instruction that writes memory or a variable
+    live at abort, there is nothing to undo and it branches there directly.
+    The rest of the trace runs in a speculation if it has such guards,
+    which abort to there, and the stubs after it commit before they leave.
+    """
+    name = trace["name"]
+    instrs = trace["instrs"]
+    # index of the first instruction that an abort would have to undo
+    undone = next((i for i, traced in enumerate(instrs)
+                   if traced.get("op") not in PURE_OPS + ["guard", "commit"] or traced.get("dest") in live[abort]),
+                  len(instrs))
+    speculative = any(traced.get("op") == "guard" and "vars" not in traced for traced in instrs[undone:])
+    fast_path = []
+    stubs = []
+    exits = {} # body of a stub->its label
+    regions = []
+    uses = {}
+    for traced in instrs:
+        for arg in traced.get("args", []):
+            uses[arg] = uses.get(arg, 0) + 1
+    def branch(cond, target):
+        num = len(fast_path)
+        labels = ["{}_trace{}".format(name, num), target]
+        if fast_path and fast_path[-1].get("op") == "not" and fast_path[-1]["dest"] == cond and uses[cond] == 1:
+            # branch on the negated value the other way around
+            cond = fast_path.pop()["args"][0]
+            labels.reverse()
+        fast_path.append({"op": "br", "args": [cond], "labels": labels})
+        fast_path.append({"label": "{}_trace{}".format(name, num)})
+    for i, traced in enumerate(instrs):
+        if i == undone and speculative:
+            fast_path.append({"op": "speculate"})
+        if traced.get("op") == "guard" and "vars" in traced:
+            body = [{"op": "commit"}] if speculative and i > undone else []
+            side = sides.get(traced["exit"])
+            if side is None:
+                body += restore(traced, traced["args"][1:], live[traced["labels"][0]])
+                body.append({"op": "jmp", "labels": traced["labels"]})
+            else:
+                body += restore(traced, traced["args"][1:], {var["name"] for var in traced["vars"]})
+                body.append({"op": "jmp", "labels": ["{}_entry".format(side["name"])]})
+                regions.append({"label": "{}_entry".format(side["name"])})
+                regions += region(side, sides, traced["labels"][0], live)
+            key = json.dumps(body, sort_keys=True)
+            if len(body) == 1:
+                exits[key] = body[0]["labels"][0]
+            elif key not in exits:
+                exits[key] = "{}_exit{}".format(name, len(fast_path))
+                stubs.append({"label": exits[key]})
+                stubs += body
+            branch(traced["args"][0], exits[key])
+        elif traced.get("op") == "guard" and i < undone:
+            branch(traced["args"][0], abort)
+        elif traced.get("op") == "guard":
+            fast_path.append({"op": "guard", "args": traced["args"], "labels": [abort]})
+        elif traced.get("op") == "commit":
+            if speculative:
+                fast_path.append({"op": "commit"})
+            fast_path += restore(traced, traced["args"], live[trace["entry"]])
+        else:
+            fast_path.append(traced)
+    fast_path.append({"op": "jmp", "labels": [trace["entry"]]}) # next iteration
+    return fast_path + stubs + regions
+
+def stitch(func, trace, sides):
+    """Run the tree of trace every time the loop reaches its header, before
+    the original body of the loop
+    """
+    entry = trace["entry"]
+    body = "{}_body".format(entry)
+    live = live_vars(func)
+    live[body] = live[entry]
+    new_instr = []
+    for instr in func["instrs"]:
+        new_instr.append(instr)
+        if instr.get("label") == entry:
+            new_instr += region(trace, sides, body, live)
+            new_instr.append({"label": body})
+    func["instrs"] = new_instr
+
 if __name__ == "__main__":
     with open(sys.argv[1], "r") as infile:
         original_program = json.load(infile)
     with open(sys.argv[2], "r") as infile:
         traced_program = json.load(infile)
-    original_instr = find_main(original_program)["instrs"]
-    traced_instr = find_main(traced_program)["instrs"]
-    new_instr = [{"op": "speculate"}]
-    for i, instr in enumerate(traced_instr):
-        if "op" in instr and instr["op"] == "guard":
-            instr["labels"] = ["trace_entry"]
-    new_instr.extend(traced_instr)
-    new_instr.append({"op": "commit"})
-    new_instr.append({"op": "jmp", "labels": ["trace_exit"]})
-    new_instr.append({"label": "trace_entry"})
-    new_instr.extend(original_instr)
-    new_instr.append({"label": "trace_exit"})
-    for i, func in enumerate(original_program["functions"]):
-        if func["name"] == "main":
-            original_program["functions"][i]["instrs"] = new_instr
+    # every hot loop, with the side traces of its tree
+    sides = {trace["name"]: trace for trace in traced_program["functions"] if "parent" in trace}
+    for trace in traced_program["functions"]:
+        if "parent" not in trace:
+            stitch(find_func(original_program, trace["func"]), trace, sides)
     with open("{}.opt.json".format(sys.argv[1].split(".")[0]), "w") as outfile:
-        outfile.write(json.dumps(original_program, indent=2))
\ No newline at end of file
+        outfile.write(json.dumps(original_program, indent=2))
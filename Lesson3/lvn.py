@@ -14,13 +14,6 @@ def lvn(prg, iterative=False):
     """
     funcs = prg["functions"]
 
-    # first find the top-level function
-    # and record the function map
-    func_map = {}
-    for func in funcs:
-        func_map[func["name"]] = func
-    top_func = func_map["main"]
-
     def runOnFunction(func):
         while True: # iterate till program is not changed (used for constant propagation)
             is_prg_changed = False
@@ -36,7 +29,7 @@ def lvn(prg, iterative=False):
             if "args" in func:
                 for arg in func["args"]:
                     arg = arg["name"]
-                    lvn_table.append((("args"), arg))
+                    lvn_table.append((("args", arg), arg)) # every argument is a value of its own
                     var2index[arg] = len(lvn_table) - 1
 
             for i, instr in enumerate(func["instrs"]):
@@ -70,12 +63,11 @@ def lvn(prg, iterative=False):
                             if var[0] == "const":
                                 instr["op"] = "const"
                                 instr["value"] = value[1]
+                            elif value[0] == "args":
+                                instr["args"] = [var]
                             else:
                                 instr["op"] = value[0]
-                                if value == "args":
-                                    instr["args"] = [var]
-                                else:
-                                    instr["args"] = list(map(lambda i: lvn_table[i][1], value[1:]))
+                                instr["args"] = list(map(lambda i: lvn_table[i][1], value[1:]))
                         else: # replace instr with copy of var
                             instr["op"] = "id"
                             instr["args"] = [var]